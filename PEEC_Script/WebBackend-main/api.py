@@ -1,11 +1,7 @@
-from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
-from app.backend.models import NotificationsTable, BugReportsTable, MasTable, IntermediateMasTable, AdvancedCoreMaterialsTable
-from app.backend.models import BugReport
-from app.backend.mas_models import MagneticCore, CoreShape, Magnetic, Inputs
+from fastapi import FastAPI, Request, HTTPException, BackgroundTasks, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, Response
+from fastapi.responses import Response, JSONResponse, StreamingResponse
 from fastapi.encoders import jsonable_encoder
-import pandas
 from datetime import datetime
 import json
 import bson
@@ -14,42 +10,96 @@ import copy
 import os
 import pathlib
 import base64
-import kombu
-import celery
+import asyncio
+import tempfile
+import time
 from pylatex import Document, Command, Package
 from pylatex.utils import NoEscape
 import PyMKF
-from OpenMagneticsVirtualBuilder.builder import Builder as ShapeBuilder  # noqa: E402
 import sys
-# sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../MVB/src/OpenMagneticsVirtualBuilder')))
-# from builder import Builder as ShapeBuilder  # noqa: E402
 import hashlib
+import email.utils
+import hmac
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), 'app/backend')))
-from plotter import purge_queue
+# Imported as the workers import them, one module instance with one engine registry and pool
+from models import NotificationsTable, BugReportsTable, MasTable, IntermediateMasTable, AdvancedCoreMaterialsTable
+from models import prepare_tables
+from models import BugReport
+from mas_models import MagneticCore, CoreShape, Magnetic, Inputs
+from plotter import warm_up, queue_depths, compute_core_shape
 from plotter import task_generate_core_3d_model, task_plot_core_and_fields, task_plot_core, task_plot_wire, task_plot_wire_and_current_density
 from plotter import task_generate_core_technical_drawing, task_generate_gapping_technical_drawing
+from plotter import prepare_core_3d_model, prepare_plot_core_and_fields, prepare_plot_core, prepare_plot_wire, prepare_plot_wire_and_current_density
+from plotter import prepare_core_technical_drawing, prepare_gapping_technical_drawing
+from plotter import core_3d_model_formats, core_3d_model_lods, core_3d_model_hash, core_3d_model_kind
+from jobs import Job, JobRegistry, ClientDisconnected, local_executor
+from executors import Lane, LaneBusy, io_executor, cpu_executor
+from writers import BatchWriter, WriterBusy
+from models import PlotCacheTable, FailedRendersTable, RequestLogTable
+from models import notifications_snapshot, advanced_core_materials_snapshot, select_active_notifications, content_version
 import ast
 import httpx
 
 temp_folder = "/opt/openmagnetics/temp"
-high_performance_backend_url = "http://86.127.248.99:8001"
+high_performance_backend_url = os.getenv('OM_HIGH_PERFORMANCE_BACKEND_URL', "http://86.127.248.99:8001")
+# Simulation archives can be hundreds of MB, so they are passed through in chunks of this size
+proxy_chunk_size = 1024 * 1024
+# Seconds an availability probe of the high performance backend is trusted
+availability_ttl = float(os.getenv('OM_HIGH_PERFORMANCE_BACKEND_AVAILABILITY_TTL', 10))
+# Token the ops endpoints expect in X-Admin-Token, which are not served at all without one
+admin_token = os.getenv('OM_ADMIN_TOKEN')
 use_celery = ast.literal_eval(os.getenv('USE_CELERY', "True"))
 use_db = "OM_DB_ADDRESS" in os.environ
-
-
-def clean_dimensions(core):
-    # Make sure no unwanted dimension gets in
-    families = ShapeBuilder("FreeCAD").get_families()
-    if "familySubtype" in core['functionalDescription']['shape'] and core['functionalDescription']['shape']['familySubtype'] is not None:
-        dimensions = families[core['functionalDescription']['shape']['family']][int(core['functionalDescription']['shape']['familySubtype'])]
-    else:
-        dimensions = families[core['functionalDescription']['shape']['family']][1]
-    aux = copy.deepcopy(core['functionalDescription']['shape']['dimensions'])
-    for key, value in core['functionalDescription']['shape']['dimensions'].items():
-        if key not in dimensions:
-            aux.pop(key)
-    core['functionalDescription']['shape']['dimensions'] = aux
-    return core
+# Total time a request waits for its job before giving up
+job_timeout = 50
+# Seconds a timed out request is answered straight away with 418
+timeout_failure_ttl = 60
+
+jobs = JobRegistry()
+# Blocking work of the async endpoints, with how many calls of each may run at once
+lanes = {
+    "plot_cache": Lane("plot_cache", io_executor, 8),
+    "database": Lane("database", io_executor, 4),
+    # Parsing, cleaning and hashing the payloads of the plot and 3D endpoints
+    "prepare": Lane("prepare", io_executor, 4),
+    "process_latex": Lane("process_latex", cpu_executor, 2, max_waiting=8),
+    "store_request": Lane("store_request", io_executor, 2, max_waiting=32),
+    # PyMKF state is global, so it shares the thread of the tasks run locally
+    "load_external_core_materials": Lane("load_external_core_materials", local_executor, 1, max_waiting=4),
+}
+# Rarely changing tables, read on most page loads, served from memory
+table_snapshots = {
+    "notifications": notifications_snapshot,
+    "advanced_core_materials": advanced_core_materials_snapshot,
+}
+# MAS documents are posted on nearly every edit, so they are written in batches
+mas_writers = {
+    "mas": BatchWriter("mas", lambda rows: MasTable().insert_mas_batch(rows)),
+    "intermediate_mas": BatchWriter("intermediate_mas", lambda rows: IntermediateMasTable().insert_mas_batch(rows)),
+}
+job_kinds = {
+    "core_technical_drawing": {"task": task_generate_core_technical_drawing, "prepare": prepare_core_technical_drawing, "extra_args": [],
+                               "content_type": "application/json", "error": "Wrong dimensions"},
+    "gapping_technical_drawing": {"task": task_generate_gapping_technical_drawing, "prepare": prepare_gapping_technical_drawing, "extra_args": [],
+                                  "content_type": "application/json", "error": "Wrong dimensions"},
+    "plot_core_and_fields": {"task": task_plot_core_and_fields, "prepare": prepare_plot_core_and_fields, "extra_args": [],
+                             "content_type": "image/svg+xml", "error": "Plotting timed out"},
+    "plot_core": {"task": task_plot_core, "prepare": prepare_plot_core, "extra_args": [],
+                  "content_type": "image/svg+xml", "error": "Plotting timed out"},
+    "plot_wire": {"task": task_plot_wire, "prepare": prepare_plot_wire, "extra_args": [],
+                  "content_type": "image/svg+xml", "error": "Plotting timed out"},
+    "plot_wire_and_current_density": {"task": task_plot_wire_and_current_density, "prepare": prepare_plot_wire_and_current_density, "extra_args": [],
+                                      "content_type": "image/svg+xml", "error": "Plotting timed out"},
+}
+
+
+for stl_or_not_step, model_formats in core_3d_model_formats.items():
+    for model_format, content_type in model_formats.items():
+        # STEP files are exact geometry, only meshes have levels of detail
+        for lod in core_3d_model_lods if stl_or_not_step else [0]:
+            job_kinds[core_3d_model_kind(stl_or_not_step, model_format, lod)] = {
+                "task": task_generate_core_3d_model, "prepare": prepare_core_3d_model, "extra_args": [stl_or_not_step, model_format, lod],
+                "content_type": content_type, "error": "Wrong dimensions"}
 
 
 def delete_none(_dict):
@@ -101,16 +151,116 @@ app.add_middleware(
 )
 
 
+@app.exception_handler(LaneBusy)
+def lane_busy(request: Request, exception: LaneBusy):
+    return JSONResponse(status_code=503, content={"detail": f"Too many {exception} requests, try again later"})
+
+
+@app.exception_handler(WriterBusy)
+def writer_busy(request: Request, exception: WriterBusy):
+    return JSONResponse(status_code=503, content={"detail": f"Too many {exception} writes pending, try again later"})
+
+
+@app.on_event("startup")
+def reflect_tables():
+    if use_db:
+        try:
+            prepare_tables([NotificationsTable, BugReportsTable, MasTable, IntermediateMasTable, AdvancedCoreMaterialsTable])
+        except Exception as e:
+            # The tables are reflected on first use instead, the endpoints that do not need Postgres still start
+            print(f"Could not reflect the tables at startup: {e}")
+
+
+@app.on_event("startup")
+def load_table_snapshots():
+    if use_db:
+        for name, snapshot in table_snapshots.items():
+            try:
+                snapshot.get()
+            except Exception as e:
+                # Loaded by the first request that needs it instead
+                print(f"Could not load {name} at startup: {e}")
+
+
+@app.on_event("startup")
+def warm_up_builders():
+    warm_up()
+
+
+http_client = None
+availability = {"available": None, "checked_at": 0}
+availability_lock = asyncio.Lock()
+
+
+@app.on_event("startup")
+async def open_http_client():
+    global http_client
+    # One keep-alive pool for every call to the high performance backend
+    http_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=32, max_keepalive_connections=8),
+                                    timeout=httpx.Timeout(600, connect=5))
+
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await http_client.aclose()
+
+
+@app.on_event("shutdown")
+def drain_mas_writers():
+    for writer in mas_writers.values():
+        writer.stop()
+
+
 @app.get("/", include_in_schema=False)
 def read_root():
     return {"Hello": "World"}
 
 
+def validated_response(request, content, version, modified_at=None):
+    """JSON response with its validators, or 304 to a GET whose copy is still current"""
+    etag = f'"{version}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if modified_at is not None:
+        headers["Last-Modified"] = email.utils.format_datetime(modified_at, usegmt=True)
+    if request.method == "GET":
+        if_none_match = request.headers.get("if-none-match")
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_none_match is not None:
+            tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+            if etag in tags or "*" in tags:
+                return Response(status_code=304, headers=headers)
+        elif if_modified_since is not None and modified_at is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                since = None
+            if since is not None and since.tzinfo is not None and modified_at <= since:
+                return Response(status_code=304, headers=headers)
+    return JSONResponse(content=jsonable_encoder(content), headers=headers)
+
+
+async def read_snapshot(snapshot):
+    # Only goes to the database lane when the snapshot has to be loaded again
+    cached = snapshot.peek()
+    if cached is not None:
+        return cached
+    try:
+        return await lanes["database"].run(snapshot.get)
+    except LaneBusy:
+        raise
+    except Exception as e:
+        # Never loaded and the database cannot be reached
+        print(f"Could not load {snapshot.name}: {e}")
+        raise HTTPException(status_code=503, detail=f"{snapshot.name} are not available, try again later")
+
+
+@app.get("/get_notifications", include_in_schema=False)
 @app.post("/get_notifications", include_in_schema=False)
-def get_notifications():
-    notifications_table = NotificationsTable()
-    new_notifications = notifications_table.read_active_notifications(datetime.now())
-    return {"notifications": new_notifications.to_dict('records')}
+async def get_notifications(request: Request):
+    snapshot = await read_snapshot(notifications_snapshot)
+    notifications, changed_at = select_active_notifications(snapshot.value, datetime.now())
+    modified_at = snapshot.modified_at if changed_at is None else max(snapshot.modified_at, changed_at)
+    return validated_response(request, {"notifications": notifications}, content_version(notifications), modified_at)
 
 
 @app.post("/report_bug", include_in_schema=False)
@@ -124,431 +274,452 @@ def report_bug(data: BugReport):
 
 @app.post("/core_compute_shape_stl", include_in_schema=False)
 @app.post("/core_compute_shape", include_in_schema=False)
-def core_compute_shape(coreShape: CoreShape):
-    coreShape = coreShape.dict()
-    core_builder = ShapeBuilder("FreeCAD").factory(coreShape)
-    core_builder.set_output_path(temp_folder)    
-    step_path, stl_path = core_builder.get_piece(coreShape)
-    if step_path is None:
-        purge_queue()
+def core_compute_shape(coreShape: CoreShape, request: Request):
+    artifact = compute_core_shape(coreShape.dict(), temp_folder, True)
+    if artifact is None:
         raise HTTPException(status_code=418, detail="Wrong dimensions")
     else:
-        return FileResponse(stl_path)
+        return artifact_response(request, artifact)
 
 
 @app.post("/core_compute_shape_stp", include_in_schema=False)
-def core_compute_shape_stp(coreShape: CoreShape):
-    coreShape = coreShape.dict()
-    core_builder = ShapeBuilder("FreeCAD").factory(coreShape)
-    core_builder.set_output_path(temp_folder)    
-    step_path, stl_path = core_builder.get_piece(coreShape)
-    if step_path is None:
-        purge_queue()
+def core_compute_shape_stp(coreShape: CoreShape, request: Request):
+    artifact = compute_core_shape(coreShape.dict(), temp_folder, False)
+    if artifact is None:
         raise HTTPException(status_code=418, detail="Wrong dimensions")
     else:
-        return FileResponse(step_path)
+        return artifact_response(request, artifact)
+
+
+def read_artifact(kind, hash_value):
+    artifact = PlotCacheTable().read_artifact(hash_value)
+    # Entries from before results were stored compressed are left to the tasks to decode
+    if artifact is not None and artifact.content_type == job_kinds[kind]["content_type"]:
+        return artifact
+    return None
+
+
+def accepts_encoding(request, encoding):
+    """Whether the Accept-Encoding of a request lists encoding, or *, with a non zero quality"""
+    accepted = {}
+    for coding in request.headers.get("accept-encoding", "").split(","):
+        name, _, parameters = coding.partition(";")
+        quality = 1.0
+        for parameter in parameters.split(";"):
+            key, _, value = parameter.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name.strip().lower()] = quality
+    return accepted.get(encoding, accepted.get("*", 0.0)) > 0
 
 
-@app.post("/core_compute_core_3d_model_stl", include_in_schema=False)
-@app.post("/core_compute_core_3d_model", include_in_schema=False)
-async def core_compute_core_3d_model(request: Request):
-    core = await request.json()
-    number_retries = 5
-    stl_data = None
+def artifact_response(request, artifact, hash_value=None):
+    headers = {"Vary": "Accept-Encoding"}
+    if hash_value is not None:
+        # Content addressed, so it can be fetched again from its own URL and cached for good
+        headers["ETag"] = f'W/"{hash_value}"'
+        headers["Content-Location"] = f"/artifacts/{hash_value}"
+    if artifact.encoding != "identity" and accepts_encoding(request, artifact.encoding):
+        headers["Content-Encoding"] = artifact.encoding
+        return Response(content=artifact.blob, media_type=artifact.content_type, headers=headers)
+    return Response(content=artifact.decode(), media_type=artifact.content_type, headers=headers)
 
-    if not use_celery:
-        print("not use_celery")
-        stl_data = task_generate_core_3d_model(core, temp_folder)
-    else:
-        try:
-            for retry in range(number_retries):
-                result = task_generate_core_3d_model.delay(core, temp_folder)
-                try:
-                    stl_data = result.get(timeout=10)
-                except celery.exceptions.TimeoutError:
-                    continue
-                except ConnectionResetError:
-                    continue
-                if stl_data is not None:
-                    break
-                print("Retrying task_generate_core_3d_model")
-            if stl_data is None:
-                purge_queue()
-        except kombu.exceptions.OperationalError:
-            stl_data = task_generate_core_3d_model(core, temp_folder)
-
-    if stl_data is None:
-        raise HTTPException(status_code=418, detail="Wrong dimensions")
+
+def read_failure(hash_value):
+    return FailedRendersTable().read_failure(hash_value)
+
+
+def record_failure(hash_value, reason, ttl=None):
+    FailedRendersTable().record_failure(hash_value, reason, ttl)
+
+
+def prepare_job(kind, data):
+    job_kind = job_kinds[kind]
+    hash_value, _ = job_kind["prepare"](data, *job_kind["extra_args"])
+    return hash_value
+
+
+async def submit_job_kind(kind, data, hash_value=None):
+    job_kind = job_kinds[kind]
+    if hash_value is None:
+        hash_value = await lanes["prepare"].run(prepare_job, kind, data)
+    return await jobs.submit(job_kind["task"], [data, temp_folder] + job_kind["extra_args"], use_celery,
+                             job_id=f"{kind}-{hash_value}", kind=kind, key=hash_value)
+
+
+async def run_job(request, kind, data, hash_value=None):
+    job_kind = job_kinds[kind]
+    if hash_value is None:
+        hash_value = await lanes["prepare"].run(prepare_job, kind, data)
+    artifact = await lanes["plot_cache"].run(read_artifact, kind, hash_value)
+    if artifact is not None:
+        return artifact_response(request, artifact, hash_value)
+
+    reason = await lanes["plot_cache"].run(read_failure, hash_value)
+    if reason is not None:
+        raise HTTPException(status_code=418, detail=reason)
+
+    job = await submit_job_kind(kind, data, hash_value)
+    try:
+        result = await jobs.wait(job, timeout=job_timeout, is_disconnected=request.is_disconnected)
+    except ClientDisconnected:
+        # Nobody else is waiting for it, so it is not worth computing anymore
+        if job.waiters == 0:
+            await jobs.cancel(job, "Client disconnected")
+        return Response(status_code=499)
+    except asyncio.TimeoutError:
+        print(f"Timed out waiting for {job_kind['task'].name}")
+        if job.waiters == 0:
+            await jobs.cancel(job, "Timed out")
+        else:
+            jobs.forget(job)
+        # Could just be a busy moment, so it is not remembered for long
+        await lanes["plot_cache"].run(record_failure, hash_value, "Timed out", timeout_failure_ttl)
+        result = None
+
+    if job.state == "failure" and job.error not in ("Timed out", "Client disconnected"):
+        await lanes["plot_cache"].run(record_failure, hash_value, job.error)
+
+    return await job_response(request, job, result)
+
+
+async def job_response(request, job, result):
+    # The task has just cached its result, so it can be sent compressed
+    artifact = await lanes["plot_cache"].run(read_artifact, job.kind, job.key)
+    if artifact is not None:
+        job.release_result()
+        return artifact_response(request, artifact, job.key)
+    if result is None:
+        raise HTTPException(status_code=418, detail=job_kinds[job.kind]["error"])
+
+    content_type = job_kinds[job.kind]["content_type"]
+    if content_type == "image/svg+xml":
+        return Response(content=result, media_type=content_type)
+    elif content_type == "application/json":
+        return result
     else:
-        # json_compatible_item_data = jsonable_encoder(stl_data, custom_encoder={bytes: lambda v: base64.b64encode(v).decode('utf-8')})
-        # return json_compatible_item_data
-        return stl_data
+        # Binary results come through the result backend as base64
+        return Response(content=base64.b64decode(result), media_type=content_type)
 
 
-@app.post("/core_compute_core_3d_model_stp", include_in_schema=False)
-async def core_compute_core_3d_model_stp(request: Request):
+def prepare_core_3d_model_hashes(core, stl_or_not_step, model_format, lod):
+    """Keys of the requested level of detail and of the full mesh, from a single parse of the core"""
+    hash_value, prepared_core = prepare_core_3d_model(core, stl_or_not_step, model_format, lod)
+    full_hash = hash_value if lod == 0 else core_3d_model_hash(prepared_core, stl_or_not_step, model_format, 0)
+    return hash_value, full_hash
+
+
+async def core_3d_model_response(request, stl_or_not_step, model_format, lod):
     core = await request.json()
-    number_retries = 5
-    stp_data = None
+    kind = core_3d_model_kind(stl_or_not_step, model_format, lod)
+    if kind not in job_kinds:
+        raise HTTPException(status_code=400, detail=f"Unknown format {model_format} or level of detail {lod}")
+    hash_value, full_hash = await lanes["prepare"].run(prepare_core_3d_model_hashes, core, stl_or_not_step, model_format, lod)
+    response = await run_job(request, kind, core, hash_value)
+    if lod != 0 and isinstance(response, Response):
+        # Cached along with this level, so the client can swap it in once it has shown this one
+        response.headers["Link"] = f'</artifacts/{full_hash}>; rel="alternate"'
+    return response
 
-    if not use_celery:
-        stp_data = task_generate_core_3d_model(core, temp_folder, False)
-    else:
-        try:
-            for retry in range(number_retries):
-                result = task_generate_core_3d_model.delay(core, temp_folder, False)
-                try:
-                    stp_data = result.get(timeout=10)
-                except celery.exceptions.TimeoutError:
-                    continue
-                except ConnectionResetError:
-                    continue
-                if stp_data is not None:
-                    break
-                print("Retrying task_generate_core_3d_model")
-            if stp_data is None:
-                purge_queue()
-        except kombu.exceptions.OperationalError:
-            stp_data = task_generate_core_3d_model(core, temp_folder, False)
-
-    if stp_data is None:
-        raise HTTPException(status_code=418, detail="Wrong dimensions")
-    else:
-        # json_compatible_item_data = jsonable_encoder(stp_data, custom_encoder={bytes: lambda v: base64.b64encode(v).decode('utf-8')})
-        # return json_compatible_item_data
-        return stp_data
+
+@app.post("/core_compute_core_3d_model_stl", include_in_schema=False)
+@app.post("/core_compute_core_3d_model", include_in_schema=False)
+async def core_compute_core_3d_model(request: Request, format: str = "json", lod: int = 0):
+    return await core_3d_model_response(request, True, format, lod)
+
+
+@app.post("/core_compute_core_3d_model_stp", include_in_schema=False)
+async def core_compute_core_3d_model_stp(request: Request, format: str = "json"):
+    return await core_3d_model_response(request, False, format, 0)
 
 
 @app.post("/core_compute_technical_drawing", include_in_schema=False)
 async def core_compute_technical_drawing(request: Request):
     data = await request.json()
-    number_retries = 5
-    views = None
-
-    if not use_celery:
-        views = task_generate_core_technical_drawing(data, temp_folder)
-    else:
-        try:
-            for retry in range(number_retries):
-                result = task_generate_core_technical_drawing.delay(data, temp_folder)
-                try:
-                    views = result.get(timeout=10)
-                except celery.exceptions.TimeoutError:
-                    continue
-                except ConnectionResetError:
-                    continue
-                if views is not None:
-                    break
-                print("Retrying task_generate_core_technical_drawing")
-            if views is None:
-                purge_queue()
-        except kombu.exceptions.OperationalError:
-            views = task_generate_core_technical_drawing(data, temp_folder)
-
-    if views is None:
-        raise HTTPException(status_code=418, detail="Wrong dimensions")
-    else:
-        return views
+    return await run_job(request, "core_technical_drawing", data)
 
 
 @app.post("/core_compute_gapping_technical_drawing", include_in_schema=False)
 async def core_compute_gapping_technical_drawing(request: Request):
     data = await request.json()
-    number_retries = 5
-    views = None
+    return await run_job(request, "gapping_technical_drawing", data)
+
+
+@app.get("/artifacts/{hash_value}", include_in_schema=False)
+async def get_artifact(hash_value: str, request: Request):
+    if request.headers.get("if-none-match") == f'W/"{hash_value}"':
+        return Response(status_code=304, headers={"ETag": f'W/"{hash_value}"'})
+    artifact = await lanes["plot_cache"].run(PlotCacheTable().read_artifact, hash_value)
+    if artifact is None or artifact.content_type is None:
+        raise HTTPException(status_code=404, detail="Not in the cache")
+    response = artifact_response(request, artifact, hash_value)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
+def require_admin(request: Request):
+    token = request.headers.get("x-admin-token")
+    if admin_token is None or token is None or not hmac.compare_digest(token.encode("utf-8"), admin_token.encode("utf-8")):
+        # The same answer as an unknown route, so they are not advertised
+        raise HTTPException(status_code=404, detail="Not Found")
+
+
+@app.get("/plot_cache_stats", include_in_schema=False, dependencies=[Depends(require_admin)])
+def plot_cache_stats():
+    return PlotCacheTable().stats()
+
+
+@app.get("/executor_stats", include_in_schema=False, dependencies=[Depends(require_admin)])
+def executor_stats():
+    return {name: lane.stats() for name, lane in lanes.items()}
+
+
+@app.get("/writer_stats", include_in_schema=False, dependencies=[Depends(require_admin)])
+def writer_stats():
+    return {name: writer.stats() for name, writer in mas_writers.items()}
+
+
+@app.get("/table_snapshot_stats", include_in_schema=False, dependencies=[Depends(require_admin)])
+def table_snapshot_stats():
+    return {name: snapshot.stats() for name, snapshot in table_snapshots.items()}
+
+
+@app.post("/invalidate_table_snapshots", include_in_schema=False, dependencies=[Depends(require_admin)])
+def invalidate_table_snapshots(name: str = None):
+    """Makes the next read load the table again, after editing it; only reaches this process"""
+    invalidated = [snapshot_name for snapshot_name in table_snapshots if name is None or name == snapshot_name]
+    for snapshot_name in invalidated:
+        table_snapshots[snapshot_name].invalidate()
+    return {"invalidated": invalidated}
 
-    if not use_celery:
-        views = task_generate_core_technical_drawing(data, temp_folder)
-    else:
-        try:
-            for retry in range(number_retries):
-                result = task_generate_gapping_technical_drawing.delay(data, temp_folder)
-                try:
-                    views = result.get(timeout=10)
-                except celery.exceptions.TimeoutError:
-                    continue
-                except ConnectionResetError:
-                    continue
-                if views is not None:
-                    break
-                print("Retrying task_generate_gapping_technical_drawing")
-            if views is None:
-                purge_queue()
-        except kombu.exceptions.OperationalError:
-            views = task_generate_core_technical_drawing(data, temp_folder)
-
-    if views is None:
-        raise HTTPException(status_code=418, detail="Wrong dimensions")
-    else:
-        return views
+
+@app.get("/queue_depths", include_in_schema=False, dependencies=[Depends(require_admin)])
+def get_queue_depths():
+    return queue_depths()
+
+
+@app.get("/failed_renders", include_in_schema=False, dependencies=[Depends(require_admin)])
+def failed_renders(limit: int = 50):
+    return FailedRendersTable().failure_counters(limit)
+
+
+def generate_pdf(tex):
+    filepath = "/opt/openmagnetics/latex"
+    pathlib.Path(filepath).mkdir(parents=True, exist_ok=True)
+    # Every build gets its own folder, so concurrent builds do not overwrite each other
+    with tempfile.TemporaryDirectory(dir=filepath) as build_folder:
+        doc = Document(default_filepath=f"{build_folder}/tex")
+        doc.packages.append(Package('array'))
+        doc.packages.append(Package('booktabs'))
+        doc.packages.append(Package('babel'))
+        doc.packages.append(Package('amsmath'))
+        doc.packages.append(Package('relsize'))
+        doc.packages.append(Package('cellspace'))
+        doc.packages.append(Package('tikz'))
+        doc.packages.append(Package('geometry'))
+        doc.packages.append(Package('fancyhdr'))
+        doc.preamble.append(Command('setlength\\cellspacetoplimit', '4pt'))
+        doc.preamble.append(Command('setlength\\cellspacebottomlimit', '4pt'))
+        doc.preamble.append(Command('usetikzlibrary', 'datavisualization'))
+        doc.preamble.append(Command('geometry', 'tmargin=1in'))
+        doc.preamble.append(Command('pagestyle', 'fancy'))
+        tex = tex.replace('μ', '$\\mu$')
+        doc.append(NoEscape(tex))
+        doc.generate_pdf(clean_tex=False)
+
+        with open(f"{build_folder}/tex.pdf", "rb") as pdf_file:
+            return base64.b64encode(pdf_file.read())
 
 
 @app.post("/process_latex", include_in_schema=True)
 async def process_latex(request: Request):
-    print(request)
-    print(dir(request))
     tex = await request.body()
     tex = tex.decode('utf-8')
-    filepath = "/opt/openmagnetics/latex"
-    pathlib.Path(filepath).mkdir(parents=True, exist_ok=True)
-    doc = Document(default_filepath=f"{filepath}/tex")
-    doc.packages.append(Package('array'))
-    doc.packages.append(Package('booktabs'))
-    doc.packages.append(Package('babel'))
-    doc.packages.append(Package('amsmath'))
-    doc.packages.append(Package('relsize'))
-    doc.packages.append(Package('cellspace'))
-    doc.packages.append(Package('tikz'))
-    doc.packages.append(Package('geometry'))
-    doc.packages.append(Package('fancyhdr'))
-    doc.preamble.append(Command('setlength\\cellspacetoplimit', '4pt'))
-    doc.preamble.append(Command('setlength\\cellspacebottomlimit', '4pt'))
-    doc.preamble.append(Command('usetikzlibrary', 'datavisualization'))
-    doc.preamble.append(Command('geometry', 'tmargin=1in'))
-    doc.preamble.append(Command('pagestyle', 'fancy'))
-    tex = tex.replace('μ', '$\\mu$')
-    doc.append(NoEscape(tex))
-    doc.generate_pdf(clean_tex=False)
-
-    with open(f"{filepath}/tex.pdf", "rb") as pdf_file:
-        pdf_string = base64.b64encode(pdf_file.read())
-        return pdf_string
+    return await lanes["process_latex"].run(generate_pdf, tex)
 
 
 @app.post("/plot_core_and_fields", include_in_schema=True)
 async def plot_core_and_fields(request: Request):
     data = await request.json()
-    number_retries = 5
-    plot = None
-
-    if not use_celery:
-        plot = task_plot_core_and_fields(data, temp_folder)
-    else:
-        try:
-            for retry in range(number_retries):
-                result = task_plot_core_and_fields.delay(data, temp_folder)
-                try:
-                    plot = result.get(timeout=10)
-                except celery.exceptions.TimeoutError:
-                    continue
-                except ConnectionResetError:
-                    continue
-                if plot is not None:
-                    break
-                print("Retrying plot_core_and_fields")
-            if plot is None:
-                purge_queue()
-        except kombu.exceptions.OperationalError:
-            plot = task_plot_core_and_fields(data, temp_folder)
-
-    if plot is None:
-        raise HTTPException(status_code=418, detail="Plotting timed out")
-
-    if plot.endswith(".svg"):
-        return FileResponse(plot)
-    else:
-        return plot
+    return await run_job(request, "plot_core_and_fields", data)
 
 
 @app.post("/plot_core", include_in_schema=True)
 async def plot_core(request: Request):
     data = await request.json()
-    number_retries = 5
-    plot = None
-
-    if not use_celery:
-        plot = task_plot_core(data, temp_folder)
-    else:
-        try:
-            for retry in range(number_retries):
-                result = task_plot_core.delay(data, temp_folder)
-                try:
-                    plot = result.get(timeout=10)
-                except celery.exceptions.TimeoutError:
-                    continue
-                except ConnectionResetError:
-                    continue
-                if plot is not None:
-                    break
-                print("Retrying task_plot_core")
-            if plot is None:
-                purge_queue()
-        except kombu.exceptions.OperationalError:
-            plot = task_plot_core(data, temp_folder)
-
-    if plot is None:
-        raise HTTPException(status_code=418, detail="Plotting timed out")
-
-    if plot.endswith(".svg"):
-        return FileResponse(plot)
-    else:
-        return plot
+    return await run_job(request, "plot_core", data)
 
 
 @app.post("/plot_wire", include_in_schema=True)
 async def plot_wire(request: Request):
     data = await request.json()
-    number_retries = 5
-    plot = None
-
-    if not use_celery:
-        plot = task_plot_wire(data, temp_folder)
-    else:
-        try:
-            for retry in range(number_retries):
-                result = task_plot_wire.delay(data, temp_folder)
-                try:
-                    plot = result.get(timeout=10)
-                except celery.exceptions.TimeoutError:
-                    continue
-                except ConnectionResetError:
-                    continue
-                if plot is not None:
-                    break
-                print("Retrying task_plot_wire")
-            if plot is None:
-                purge_queue()
-        except kombu.exceptions.OperationalError:
-            plot = task_plot_wire(data, temp_folder)
-
-    if plot is None:
-        raise HTTPException(status_code=418, detail="Plotting timed out")
-
-    if plot.endswith(".svg"):
-        return FileResponse(plot)
-    else:
-        return plot
+    return await run_job(request, "plot_wire", data)
 
 
 @app.post("/plot_wire_and_current_density", include_in_schema=True)
 async def plot_wire_and_current_density(request: Request):
     data = await request.json()
-    number_retries = 5
-    plot = None
+    return await run_job(request, "plot_wire_and_current_density", data)
 
-    if not use_celery:
-        plot = task_plot_wire_and_current_density(data, temp_folder)
-    else:
-        try:
-            for retry in range(number_retries):
-                result = task_plot_wire_and_current_density.delay(data, temp_folder)
-                try:
-                    plot = result.get(timeout=10)
-                except celery.exceptions.TimeoutError:
-                    continue
-                except ConnectionResetError:
-                    continue
-                if plot is not None:
-                    break
-                print("Retrying task_plot_wire_and_current_density")
-            if plot is None:
-                purge_queue()
-        except kombu.exceptions.OperationalError:
-            plot = task_plot_wire_and_current_density(data, temp_folder)
-
-    if plot is None:
-        raise HTTPException(status_code=418, detail="Plotting timed out")
-
-    if plot.endswith(".svg"):
-        return FileResponse(plot)
-    else:
-        return plot
 
-
-def insert_mas_background(data):
-    mas_table = MasTable()
-    mas_table.insert_mas(data)
+@app.post("/jobs/{kind}", include_in_schema=True)
+async def submit_job(kind: str, request: Request):
+    if kind not in job_kinds:
+        raise HTTPException(status_code=404, detail="Unknown job kind")
+    data = await request.json()
+    job = await submit_job_kind(kind, data)
+    await jobs.refresh(job)
+    return job.to_dict()
+
+
+def find_finished_job(job_id):
+    """A job submitted by another API process, known once its result is cached or it failed"""
+    for kind, job_kind in job_kinds.items():
+        if not job_id.startswith(f"{kind}-"):
+            continue
+        key = job_id[len(kind) + 1:]
+        job = Job(job_id, job_kind["task"].name, kind, key)
+        if read_artifact(kind, key) is not None:
+            job.finish("success")
+            job.release_result()
+            return job
+        reason = read_failure(key)
+        if reason is not None:
+            job.finish("failure", error=reason)
+            return job
+    return None
+
+
+async def get_job_or_404(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        job = await lanes["plot_cache"].run(find_finished_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return job
+
+
+@app.get("/jobs/{job_id}", include_in_schema=True)
+async def get_job_status(job_id: str):
+    job = await get_job_or_404(job_id)
+    await jobs.refresh(job)
+    return job.to_dict()
+
+
+@app.get("/jobs/{job_id}/result", include_in_schema=True)
+async def get_job_result(job_id: str, request: Request):
+    job = await get_job_or_404(job_id)
+    await jobs.refresh(job)
+    if not job.done:
+        return JSONResponse(status_code=202, content=job.to_dict())
+    return await job_response(request, job, job.result)
+
+
+@app.get("/jobs/{job_id}/events", include_in_schema=True)
+async def get_job_events(job_id: str):
+    job = await get_job_or_404(job_id)
+    return StreamingResponse(jobs.events(job), media_type="text/event-stream")
 
 
 @app.post("/insert_mas", include_in_schema=False)
-async def insert_mas(request: Request, background_tasks: BackgroundTasks):
+async def insert_mas(request: Request):
     data = await request.json()
-    background_tasks.add_task(insert_mas_background, data)
+    mas_writers["mas"].submit((data, datetime.now()))
 
     return "Inserting in the background"
 
 
-def insert_intermediate_mas_background(data):
-    mas_table = IntermediateMasTable()
-    mas_table.insert_mas(data)
-
-
 @app.post("/insert_intermediate_mas", include_in_schema=False)
-async def insert_intermediate_mas(request: Request, background_tasks: BackgroundTasks):
+async def insert_intermediate_mas(request: Request):
     if use_db:
         data = await request.json()
-        background_tasks.add_task(insert_intermediate_mas_background, data)
+        mas_writers["intermediate_mas"].submit((data, datetime.now()))
 
         return "Inserting in the background"
     else:
         return "DB not available"
 
 
+def load_core_materials(core_materials_string):
+    PyMKF.load_core_materials(core_materials_string)
+    PyMKF.load_core_materials("")
+
+
 @app.post("/load_external_core_materials", include_in_schema=False)
 async def load_external_core_materials(request: Request, background_tasks: BackgroundTasks):
     data = await request.json()
 
     external_core_materials_string = data["coreMaterialsString"]
 
-    PyMKF.load_core_materials(external_core_materials_string)
-    PyMKF.load_core_materials("")
+    await lanes["load_external_core_materials"].run(load_core_materials, external_core_materials_string)
     return "Data loaded"
 
 
 @app.post("/store_request", include_in_schema=False)
 async def store_request(request: Request, background_tasks: BackgroundTasks):
     data = await request.json()
-
-    request = {
-        "email": data["email"],
-        "name": data["name"],
-        "mas": data["mas"],
-    }
-
-    file = "/opt/openmagnetics/temp/requests.csv"
-
-    requests = pandas.DataFrame()
-
-    if os.path.exists(file):
-        requests = pandas.read_csv(file)
-
-    row = pandas.DataFrame([request])
-    print(row)
-
-    requests = pandas.concat([requests, row], ignore_index=True)
-    print(requests)
-
-    requests.to_csv(file)
+    await lanes["store_request"].run(RequestLogTable().append_request, data["email"], data["name"], data["mas"])
 
 
+@app.get("/read_advanced_core_material_by_name", include_in_schema=False)
 @app.post("/read_advanced_core_material_by_name", include_in_schema=False)
-async def read_advanced_core_material_by_name(request: Request):
-    dataJson = await request.json()
-    advanced_core_materials_table = AdvancedCoreMaterialsTable()
-    advanced_core_material_data = advanced_core_materials_table.read_material_by_name(dataJson["name"])
+async def read_advanced_core_material_by_name(request: Request, name: str = None):
+    if name is None:
+        dataJson = await request.json()
+        name = dataJson["name"]
+    snapshot = await read_snapshot(advanced_core_materials_snapshot)
+    advanced_core_material_data = snapshot.value.get(name)
+    if advanced_core_material_data is None:
+        raise HTTPException(status_code=404, detail="Unknown material")
 
-    return advanced_core_material_data
+    return validated_response(request, advanced_core_material_data, content_version(advanced_core_material_data), snapshot.modified_at)
 
 
 @app.post("/create_simulation_from_mas", include_in_schema=False)
 async def create_simulation_from_mas(request: Request):
-    data = await request.json()
     url = f'{high_performance_backend_url}/create_simulation_from_mas'
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, json=data, timeout=600)
-        # print(response.content)
-        print("len(response.content)")
-        print(len(response.content))
-        return Response(content=response.content, media_type="binary/octet-stream")
+    # Neither the MAS nor the archive are held in memory, both are streamed through. The archive is
+    # passed through as sent, so the backend may only compress it in a way the client accepts.
+    headers = {
+        "content-type": request.headers.get("content-type", "application/json"),
+        "accept-encoding": request.headers.get("accept-encoding", "identity"),
+    }
+    remote_request = http_client.build_request("POST", url, content=request.stream(), headers=headers)
+    response = await http_client.send(remote_request, stream=True)
+
+    encoding = response.headers.get("content-encoding", "identity")
+    passed_through = encoding == "identity" or accepts_encoding(request, encoding)
+
+    async def body():
+        try:
+            # The content-length of the backend counts the bytes as sent, compressed or not
+            chunks = response.aiter_raw(proxy_chunk_size) if passed_through else response.aiter_bytes(proxy_chunk_size)
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            await response.aclose()
+
+    headers = {}
+    if passed_through:
+        for header in ("content-encoding", "content-length"):
+            if header in response.headers:
+                headers[header] = response.headers[header]
+    return StreamingResponse(body(), status_code=response.status_code, media_type="binary/octet-stream", headers=headers)
 
 
 @app.post("/is_high_performance_backend_available", include_in_schema=False)
 async def is_high_performance_backend_available():
-    try:
-        url = f'{high_performance_backend_url}/remote_available'
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, timeout=5)
-            print("Remote available")
-            return True
-    except Exception:
-        return False
+    async with availability_lock:
+        if availability["available"] is None or time.monotonic() - availability["checked_at"] > availability_ttl:
+            try:
+                url = f'{high_performance_backend_url}/remote_available'
+                await http_client.post(url, timeout=5)
+                print("Remote available")
+                availability["available"] = True
+            except Exception:
+                availability["available"] = False
+            availability["checked_at"] = time.monotonic()
+        return availability["available"]
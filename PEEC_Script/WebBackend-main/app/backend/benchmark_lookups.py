@@ -0,0 +1,135 @@
+"""Times the user lookups against reading the same rows through pandas.read_sql, as they were read before,
+on a local SQLite copy of the users table.
+
+Usage:
+    python benchmark_lookups.py
+    python benchmark_lookups.py --users 10000 --calls 2000
+"""
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+import time
+import pandas
+import sqlalchemy
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+from models import UsersTable, get_engine, get_mapped_class, get_session_factory
+
+
+class SQLiteUsersTable(UsersTable):
+
+    url = None
+
+    def connect(self, schema=None):
+        self.engine = get_engine(self.url)
+        self.Table = get_mapped_class(self.engine, self.table_name, None)
+        self.session = get_session_factory(self.engine)()
+
+
+class ReadSqlUsersTable(SQLiteUsersTable):
+    """The lookups as they were, building a DataFrame for each"""
+
+    def read(self, query):
+        self.connect()
+        data = pandas.read_sql(query(self.Table).statement, self.session.bind)
+        self.disconnect()
+        return data
+
+    def username_exists(self, username):
+        return not self.read(lambda Table: self.session.query(Table).filter(Table.username == username)).empty
+
+    def email_exists(self, email):
+        return not self.read(lambda Table: self.session.query(Table).filter(Table.email == email)).empty
+
+    def get_user_id(self, username=None, user_id=None):
+        if username is not None:
+            data = self.read(lambda Table: self.session.query(Table).filter(Table.username == username))
+        else:
+            data = self.read(lambda Table: self.session.query(Table).filter(Table.id == user_id))
+        return None if data.empty else data.iloc[0]['id']
+
+    def password_by_username(self, username):
+        data = self.read(lambda Table: self.session.query(Table).filter(Table.username == username))
+        return None if data.empty else data.iloc[0]['password']
+
+    def get_username(self, user_id):
+        data = self.read(lambda Table: self.session.query(Table).filter(Table.id == user_id))
+        return None if data.empty else data.iloc[0]['username']
+
+
+class LookupUsersTable(SQLiteUsersTable):
+
+    def password_by_username(self, username):
+        return self.lookup("password_by_username", username=username)
+
+
+def create_users(url, count):
+    engine = get_engine(url)
+    metadata = sqlalchemy.MetaData()
+    users = sqlalchemy.Table(
+        "users", metadata,
+        sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+        sqlalchemy.Column("username", sqlalchemy.String, unique=True),
+        sqlalchemy.Column("password", sqlalchemy.String),
+        sqlalchemy.Column("email", sqlalchemy.String, unique=True),
+        sqlalchemy.Column("created_at", sqlalchemy.DateTime),
+        sqlalchemy.Column("updated_at", sqlalchemy.DateTime),
+    )
+    metadata.create_all(engine)
+    now = datetime.datetime.now()
+    # A fixed hash, bcrypt would take longer than the whole benchmark
+    rows = [{"id": i + 1, "username": f"user{i}", "password": "$2b$12$" + "x" * 53, "email": f"user{i}@example.com",
+             "created_at": now, "updated_at": now} for i in range(count)]
+    with engine.begin() as connection:
+        connection.execute(users.insert(), rows)
+
+
+def lookups(table, users):
+    return {
+        "username_exists": lambda i: table.username_exists(f"user{i % (2 * users)}"),
+        "email_exists": lambda i: table.email_exists(f"user{i % (2 * users)}@example.com"),
+        "get_user_id": lambda i: table.get_user_id(username=f"user{i % users}"),
+        "get_username": lambda i: table.get_username(i % users + 1),
+        "password_by_username": lambda i: table.password_by_username(f"user{i % users}"),
+    }
+
+
+def time_calls(function, calls):
+    function(0)
+    t_start = time.perf_counter()
+    for i in range(calls):
+        function(i)
+    return (time.perf_counter() - t_start) / calls
+
+
+def check_same_results(read_sql_table, lookup_table, users):
+    expected = lookups(read_sql_table, users)
+    actual = lookups(lookup_table, users)
+    for name in expected:
+        for i in (0, users - 1, users, 2 * users - 1):
+            if expected[name](i) != actual[name](i):
+                raise AssertionError(f"{name}({i}) differs: {expected[name](i)!r} != {actual[name](i)!r}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the user lookups on SQLite")
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--calls', type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        url = f"sqlite:///{os.path.join(folder, 'users.db')}"
+        SQLiteUsersTable.url = url
+        create_users(url, args.users)
+        read_sql_table = ReadSqlUsersTable()
+        lookup_table = LookupUsersTable()
+        check_same_results(read_sql_table, lookup_table, args.users)
+
+        print(f"{'lookup':<22}{'read_sql (us)':>15}{'lookup (us)':>15}{'speedup':>10}")
+        read_sql_lookups = lookups(read_sql_table, args.users)
+        for name, function in lookups(lookup_table, args.users).items():
+            before = time_calls(read_sql_lookups[name], args.calls)
+            after = time_calls(function, args.calls)
+            print(f"{name:<22}{before * 1e6:>15.0f}{after * 1e6:>15.0f}{before / after:>9.1f}x")
+        get_engine(url).dispose()
@@ -0,0 +1,30 @@
+"""Gives the space freed by plot cache evictions back to the filesystem.
+
+Usage:
+    python compact_plots.py            # Frees every free page, without rewriting the file
+    python compact_plots.py --full     # Rewrites the file once, switching an older cache to incremental vacuum
+
+Evictions already free a bounded number of pages on their own; this is for cron or by hand. --full needs as much
+free disk as the cache file and blocks the writes of the workers while it runs, so run it when they are stopped.
+"""
+import argparse
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+from models import PlotCacheTable
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compact the plot cache")
+    parser.add_argument('--full', action='store_true', help="rewrite the whole file with VACUUM")
+    args = parser.parse_args()
+
+    plot_cache = PlotCacheTable()
+    if args.full:
+        mode = plot_cache.vacuum()
+        print(f"Plot cache rewritten, auto_vacuum is now {mode}")
+    else:
+        plot_cache.connect()
+        plot_cache.compact()
+        plot_cache.disconnect()
+        print("Plot cache compacted")
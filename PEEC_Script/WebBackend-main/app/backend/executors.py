@@ -0,0 +1,104 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Short blocking calls: SQLite, Mongo and Postgres reads and writes
+io_executor = ThreadPoolExecutor(max_workers=int(os.getenv('OM_IO_THREADS', 8)), thread_name_prefix="io")
+# Long CPU or subprocess bound calls, like LaTeX builds and CSV rewrites
+cpu_executor = ThreadPoolExecutor(max_workers=int(os.getenv('OM_CPU_THREADS', 2)), thread_name_prefix="cpu")
+
+
+class LaneBusy(Exception):
+    pass
+
+
+class Lane:
+    """Runs the blocking calls of one endpoint on an executor, so they never block the event loop.
+
+    At most limit calls of a lane are in the executor at once, the rest wait their turn, and once
+    max_waiting are already waiting new calls raise LaneBusy instead of piling up. The time between
+    a call being made and it starting to run is reported as its queue time.
+    """
+
+    def __init__(self, name, executor, limit, max_waiting=None):
+        self.name = name
+        self.executor = executor
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.semaphore = asyncio.Semaphore(limit)
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.running = 0
+        self.calls = 0
+        self.rejected = 0
+        self.errors = 0
+        self.queue_time_total = 0
+        self.queue_time_max = 0
+        self.run_time_total = 0
+        self.run_time_max = 0
+
+    async def run(self, function, *args, **kwargs):
+        with self.lock:
+            if self.max_waiting is not None and self.waiting >= self.max_waiting:
+                self.rejected += 1
+                raise LaneBusy(self.name)
+            self.waiting += 1
+        queued_at = time.monotonic()
+        try:
+            await self.semaphore.acquire()
+        except BaseException:
+            # Cancelled before it got to the executor
+            with self.lock:
+                self.waiting -= 1
+            raise
+
+        def call():
+            # Once submitted, only this wrapper touches the counters, whether the caller still waits or not
+            started_at = time.monotonic()
+            with self.lock:
+                self.waiting -= 1
+                self.running += 1
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                with self.lock:
+                    self.errors += 1
+                raise
+            finally:
+                finished_at = time.monotonic()
+                with self.lock:
+                    self.running -= 1
+                    self.calls += 1
+                    self.queue_time_total += started_at - queued_at
+                    self.queue_time_max = max(self.queue_time_max, started_at - queued_at)
+                    self.run_time_total += finished_at - started_at
+                    self.run_time_max = max(self.run_time_max, finished_at - started_at)
+
+        def finished(future):
+            # The slot is only given back once the call is done, even if the caller went away
+            self.semaphore.release()
+            if not future.cancelled():
+                future.exception()
+
+        future = asyncio.get_running_loop().run_in_executor(self.executor, call)
+        future.add_done_callback(finished)
+        # Shielded, so a cancelled caller does not cancel a call the executor may already be running
+        return await asyncio.shield(future)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "limit": self.limit,
+                "waiting": self.waiting,
+                "running": self.running,
+                "calls": self.calls,
+                "rejected": self.rejected,
+                "errors": self.errors,
+                "queue_time_average": self.queue_time_total / self.calls if self.calls > 0 else 0,
+                "queue_time_max": self.queue_time_max,
+                "run_time_average": self.run_time_total / self.calls if self.calls > 0 else 0,
+                "run_time_max": self.run_time_max,
+            }
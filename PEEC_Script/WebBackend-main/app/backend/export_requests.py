@@ -0,0 +1,34 @@
+"""Writes the request log to a CSV file.
+
+Usage:
+    python export_requests.py                   # Writes /opt/openmagnetics/temp/requests_export.csv
+    python export_requests.py requests.csv
+"""
+import argparse
+import csv
+import datetime
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+from models import RequestLogTable
+
+
+def export_requests(output_file):
+    count = 0
+    with open(output_file, "w", newline="") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=["created_at", "email", "name", "mas"])
+        writer.writeheader()
+        for request in RequestLogTable().iterate_requests():
+            request["created_at"] = datetime.datetime.fromtimestamp(request["created_at"]).isoformat()
+            writer.writerow(request)
+            count += 1
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export the request log to CSV")
+    parser.add_argument('output_file', nargs='?', default="/opt/openmagnetics/temp/requests_export.csv")
+    args = parser.parse_args()
+
+    count = export_requests(args.output_file)
+    print(f"Exported {count} requests to {args.output_file}")
@@ -0,0 +1,226 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import kombu.exceptions
+
+
+# Celery result backends are not thread safe, so every call that touches them goes through this
+# single thread, which also keeps broker and backend round trips off the event loop.
+celery_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="celery-results")
+# Tasks run in-process when Celery is disabled or the broker is down. PyMKF settings are global,
+# so they run one at a time.
+local_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="local-tasks")
+
+celery_states = {
+    "PENDING": "pending",
+    "RECEIVED": "pending",
+    "RETRY": "pending",
+    "STARTED": "running",
+    "SUCCESS": "success",
+    "FAILURE": "failure",
+    "REVOKED": "failure",
+}
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+def compute_job_id(task_name, args):
+    """Identifies a job by its content, so identical submissions end up in the same job"""
+    payload = json.dumps([task_name, args], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class Job:
+    def __init__(self, job_id, task_name, kind=None, key=None):
+        self.job_id = job_id
+        self.task_name = task_name
+        self.kind = kind
+        # Cache key of the result, when the task caches it
+        self.key = key
+        self.state = "pending"
+        self.result = None
+        # Set once the result is in the plot cache and no longer held here
+        self.cached = False
+        self.error = None
+        self.submitted_at = time.time()
+        self.finished_at = None
+        self.async_result = None
+        self.future = None
+        # Requests currently waiting for this job
+        self.waiters = 0
+
+    @property
+    def done(self):
+        return self.state in ("success", "failure")
+
+    @property
+    def failed(self):
+        return self.state == "failure" or (self.done and self.result is None and not self.cached)
+
+    def finish(self, state, result=None, error=None):
+        self.state = state
+        self.result = result
+        self.error = error
+        self.finished_at = time.time()
+
+    def release_result(self):
+        """Drops the result once it is served from the plot cache, it can be several MB"""
+        self.result = None
+        self.cached = True
+
+    def poll(self):
+        if self.done:
+            return
+        if self.future is None and self.async_result is None:
+            # Still being sent to the broker
+            return
+        if self.future is not None:
+            if not self.future.done():
+                self.state = "running" if self.future.running() else "pending"
+            elif self.future.exception() is not None:
+                self.finish("failure", error=repr(self.future.exception()))
+            else:
+                self.finish("success", result=self.future.result())
+        else:
+            state = celery_states.get(self.async_result.state, "pending")
+            if state == "success":
+                self.finish(state, result=self.async_result.result)
+            elif state == "failure":
+                self.finish(state, error=repr(self.async_result.result))
+            else:
+                self.state = state
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "task": self.task_name,
+            "kind": self.kind,
+            "status": self.state,
+            "error": self.error,
+            "submitted_at": self.submitted_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobRegistry:
+    """Keeps track of the jobs submitted by this process.
+
+    Submitting a job whose id is already running attaches to it instead of enqueuing a duplicate,
+    and finished jobs are kept around for a while so their status can be fetched. Running jobs are
+    only known to the process that submitted them; other API processes can only tell a finished
+    job from the plot cache and the failed renders.
+    """
+
+    def __init__(self, retention=300):
+        self.retention = retention
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def prune(self):
+        now = time.time()
+        with self.lock:
+            for job_id, job in list(self.jobs.items()):
+                if job.done and now - job.finished_at > self.retention:
+                    self.jobs.pop(job_id)
+
+    def get(self, job_id):
+        self.prune()
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def forget(self, job):
+        with self.lock:
+            if self.jobs.get(job.job_id) is job:
+                self.jobs.pop(job.job_id)
+
+    async def submit(self, task, args, use_celery=True, job_id=None, kind=None, key=None):
+        if job_id is None:
+            job_id = compute_job_id(task.name, args)
+
+        self.prune()
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None and not job.failed:
+                return job
+            job = Job(job_id, task.name, kind, key)
+            self.jobs[job_id] = job
+
+        loop = asyncio.get_running_loop()
+        if use_celery:
+            # Workers remember revoked ids for hours, so every submission gets its own task id
+            # or revoking one would also drop later submissions of the same job
+            try:
+                job.async_result = await loop.run_in_executor(celery_executor, lambda: task.apply_async(args=args, task_id=f"{job_id}-{uuid.uuid4().hex[:12]}"))
+                return job
+            except kombu.exceptions.OperationalError:
+                print("Broker not available, running task locally")
+
+        job.future = local_executor.submit(task, *args)
+        return job
+
+    async def cancel(self, job, reason, terminate=False):
+        """Revokes this job only, leaving the rest of the queue alone.
+
+        A job that has not started is dropped from the queue; terminating also kills the worker
+        process running it.
+        """
+        self.forget(job)
+        if job.done:
+            return
+        if job.future is not None:
+            job.future.cancel()
+        elif job.async_result is not None:
+            print(f"Revoking {job.job_id}: {reason}")
+            await asyncio.get_running_loop().run_in_executor(celery_executor, lambda: job.async_result.revoke(terminate=terminate))
+        job.finish("failure", error=reason)
+
+    async def refresh(self, job):
+        if job.done:
+            return job
+        if job.future is not None:
+            job.poll()
+        else:
+            await asyncio.get_running_loop().run_in_executor(celery_executor, job.poll)
+        return job
+
+    async def wait(self, job, timeout, is_disconnected=None):
+        """Waits for a job without blocking the event loop, raising asyncio.TimeoutError if it does not finish in time.
+
+        If is_disconnected is given, it is awaited between polls and ClientDisconnected is raised
+        once it returns True.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        delay = 0.02
+        job.waiters += 1
+        try:
+            await self.refresh(job)
+            while not job.done:
+                if loop.time() >= deadline:
+                    raise asyncio.TimeoutError
+                if is_disconnected is not None and await is_disconnected():
+                    raise ClientDisconnected
+                await asyncio.sleep(min(delay, max(deadline - loop.time(), 0)))
+                delay = min(delay * 2, 0.5)
+                await self.refresh(job)
+            return job.result
+        finally:
+            job.waiters -= 1
+
+    async def events(self, job, interval=0.25):
+        """Server-sent events with the status of a job, until it finishes"""
+        last_state = None
+        while True:
+            await self.refresh(job)
+            if job.state != last_state:
+                last_state = job.state
+                yield f"event: status\ndata: {json.dumps(job.to_dict())}\n\n"
+            if job.done:
+                break
+            await asyncio.sleep(interval)
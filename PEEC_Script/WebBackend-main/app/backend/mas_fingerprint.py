@@ -0,0 +1,40 @@
+"""Canonical content hash of MAS documents, shared by the web backend caches and the PEEC scripts.
+
+Only depends on the standard library, so the scripts can import it straight from this folder.
+"""
+import hashlib
+import json
+import math
+
+
+significant_digits = 9
+# Keys that name or describe a document without changing what is computed from it
+ignored_keys = frozenset(["name", "manufacturerInfo", "username", "slug", "_id", "created_at", "updated_at", "deleted_at"])
+
+
+def canonicalize(value, digits=significant_digits, ignored=ignored_keys):
+    """Returns a copy of value with the nulls and ignored keys dropped and every number rounded
+    to the given significant digits as a float, so 1, 1.0 and 1.0000000000001 all look the same"""
+    if isinstance(value, dict):
+        return {str(key): canonicalize(item, digits, ignored) for key, item in value.items()
+                if item is not None and key not in ignored}
+    if isinstance(value, (list, tuple)):
+        return [canonicalize(item, digits, ignored) for item in value]
+    if isinstance(value, bool) or value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)):
+        if not math.isfinite(value):
+            return str(value)
+        # + 0.0 turns -0.0 into 0.0, which browsers send as 0
+        return float(f"{value:.{digits}g}") + 0.0
+    return str(value)
+
+
+def fingerprint(value, kind=None, digits=significant_digits, ignored=ignored_keys):
+    """Hex digest identifying value up to key order, number formatting and float noise.
+
+    The kind namespaces the hash, so different artifacts computed from the same document do not
+    share a key.
+    """
+    payload = json.dumps([kind, canonicalize(value, digits, ignored)], sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=32).hexdigest()
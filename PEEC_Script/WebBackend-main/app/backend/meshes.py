@@ -0,0 +1,135 @@
+"""Conversions of the STL meshes written by FreeCAD into compact formats for the browser."""
+import json
+import re
+import struct
+import numpy
+
+
+stl_record = numpy.dtype([("normal", "<f4", (3,)), ("vertices", "<f4", (3, 3)), ("attribute", "<u2")])
+stl_vertex_pattern = re.compile(rb"vertex\s+(\S+)\s+(\S+)\s+(\S+)")
+
+# glTF constants
+unsigned_short = 5123
+unsigned_int = 5125
+array_buffer = 34962
+element_array_buffer = 34963
+triangles_mode = 4
+
+
+def is_binary_stl(data):
+    if len(data) < 84:
+        return False
+    count = struct.unpack_from("<I", data, 80)[0]
+    return 84 + count * stl_record.itemsize == len(data)
+
+
+def read_stl(data):
+    """Triangles of a binary or ASCII STL file, as an (n, 3, 3) float32 array"""
+    if is_binary_stl(data):
+        count = struct.unpack_from("<I", data, 80)[0]
+        return numpy.frombuffer(data, dtype=stl_record, count=count, offset=84)["vertices"].astype(numpy.float32)
+    coordinates = stl_vertex_pattern.findall(data)
+    return numpy.array(coordinates, dtype=numpy.float32).reshape(-1, 3, 3)
+
+
+def write_binary_stl(triangles):
+    normals = numpy.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    lengths = numpy.linalg.norm(normals, axis=1, keepdims=True)
+    normals = numpy.divide(normals, lengths, out=numpy.zeros_like(normals), where=lengths > 0)
+    records = numpy.zeros(len(triangles), dtype=stl_record)
+    records["normal"] = normals
+    records["vertices"] = triangles
+    header = b"OpenMagnetics binary STL".ljust(80, b" ")
+    return header + struct.pack("<I", len(triangles)) + records.tobytes()
+
+
+def to_binary_stl(data):
+    """FreeCAD may write ASCII STL, which is several times bigger and slower to parse"""
+    if is_binary_stl(data):
+        return data
+    return write_binary_stl(read_stl(data))
+
+
+def index_triangles(triangles):
+    """Merges the vertices repeated by every triangle that shares them, returning the unique
+    vertices and three indices into them per triangle"""
+    vertices, indices = numpy.unique(triangles.reshape(-1, 3), axis=0, return_inverse=True)
+    return vertices, indices.reshape(-1)
+
+
+def decimate(triangles, cell_fraction):
+    """Coarser version of a mesh, made by merging all the vertices that fall in the same cell of a
+    grid whose cells measure cell_fraction of the biggest side of the mesh. Triangles that collapse
+    into a line or a point are dropped."""
+    vertices, indices = index_triangles(triangles)
+    low = vertices.min(axis=0)
+    cell = float((vertices.max(axis=0) - low).max()) * cell_fraction
+    if cell <= 0:
+        return triangles
+    cells = numpy.floor((vertices - low) / cell).astype(numpy.int64)
+    _, clusters, counts = numpy.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    clusters = clusters.reshape(-1)
+    sums = numpy.zeros((len(counts), 3))
+    numpy.add.at(sums, clusters, vertices)
+    centers = (sums / counts[:, None]).astype(numpy.float32)
+
+    faces = clusters[indices].reshape(-1, 3)
+    faces = faces[(faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])]
+    return centers[numpy.unique(faces, axis=0)]
+
+
+def pad(data, filler=b"\0"):
+    return data + filler * (-len(data) % 4)
+
+
+def write_glb(triangles, position_bits=16):
+    """GLB with the triangles indexed and their positions quantized to position_bits per axis
+    (KHR_mesh_quantization); the node transform scales them back to the original units"""
+    if len(triangles) == 0:
+        raise ValueError("The mesh has no triangles")
+    vertices, indices = index_triangles(triangles)
+
+    low = vertices.min(axis=0).astype(numpy.float64)
+    high = vertices.max(axis=0).astype(numpy.float64)
+    scale = numpy.where(high > low, (high - low) / (2 ** position_bits - 1), 1.0)
+    quantized = numpy.round((vertices - low) / scale).astype(numpy.uint16)
+    # Vertex attributes must be aligned to 4 bytes, so each position takes 8
+    positions = numpy.zeros((len(quantized), 4), dtype=numpy.uint16)
+    positions[:, :3] = quantized
+    position_bytes = positions.tobytes()
+
+    if len(vertices) <= 65535:
+        index_bytes = indices.astype(numpy.uint16).tobytes()
+        index_type = unsigned_short
+    else:
+        index_bytes = indices.astype(numpy.uint32).tobytes()
+        index_type = unsigned_int
+    binary = position_bytes + pad(index_bytes)
+
+    gltf = {
+        "asset": {"version": "2.0", "generator": "OpenMagnetics"},
+        "extensionsUsed": ["KHR_mesh_quantization"],
+        "extensionsRequired": ["KHR_mesh_quantization"],
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        "nodes": [{"mesh": 0, "translation": low.tolist(), "scale": scale.tolist()}],
+        "meshes": [{"primitives": [{"attributes": {"POSITION": 0}, "indices": 1, "mode": triangles_mode}]}],
+        "buffers": [{"byteLength": len(binary)}],
+        "bufferViews": [
+            {"buffer": 0, "byteOffset": 0, "byteLength": len(position_bytes), "byteStride": 8, "target": array_buffer},
+            {"buffer": 0, "byteOffset": len(position_bytes), "byteLength": len(index_bytes), "target": element_array_buffer},
+        ],
+        "accessors": [
+            {"bufferView": 0, "componentType": unsigned_short, "count": len(quantized), "type": "VEC3",
+             "min": quantized.min(axis=0).tolist(), "max": quantized.max(axis=0).tolist()},
+            {"bufferView": 1, "componentType": index_type, "count": len(indices), "type": "SCALAR"},
+        ],
+    }
+    json_chunk = pad(json.dumps(gltf, separators=(",", ":")).encode("utf-8"), b" ")
+
+    length = 12 + 8 + len(json_chunk) + 8 + len(binary)
+    return b"".join([
+        struct.pack("<4sII", b"glTF", 2, length),
+        struct.pack("<I4s", len(json_chunk), b"JSON"), json_chunk,
+        struct.pack("<I4s", len(binary), b"BIN\0"), binary,
+    ])
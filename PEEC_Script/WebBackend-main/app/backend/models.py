@@ -5,13 +5,24 @@ import bcrypt
 import os
 from pydantic import BaseModel
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Table, MetaData
+from sqlalchemy import Column, Integer, String, Float, LargeBinary, DateTime, Table, MetaData
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
 import datetime
 from typing import List, Optional, Any, Union
 from enum import Enum
 from pymongo import MongoClient
 from bson import ObjectId, json_util
 import json
+import ast
+import copy
+import threading
+import time
+import collections
+import gzip
+import hashlib
+import zlib
+import sqlite3
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.orm.exc import MultipleResultsFound
 
@@ -140,106 +151,158 @@ class BugReport(BaseModel):
     username: Optional[str] = None
 
 
+def get_postgres_url():
+    driver = "postgresql"
+    address = os.getenv('OM_DB_ADDRESS')
+    port = os.getenv('OM_DB_PORT')
+    name = os.getenv('OM_DB_NAME')
+    user = os.getenv('OM_DB_USER')
+    password = os.getenv('OM_DB_PASSWORD')
+    return f"{driver}://{user}:{password}@{address}:{port}/{name}"
+
+
+# Engines, reflected classes and session factories are shared by the whole process, so a query
+# only pays for checking a connection out of the pool instead of connecting and reflecting again.
+_registry_lock = threading.RLock()
+_engines = {}
+_mapped_classes = {}
+_session_factories = {}
+_mongo_clients = {}
+_lookup_statements = {}
+
+
+def get_engine(url, **kwargs):
+    with _registry_lock:
+        engine = _engines.get(url)
+        if engine is None:
+            engine = sqlalchemy.create_engine(url, **kwargs)
+            _engines[url] = engine
+        return engine
+
+
+def get_postgres_engine():
+    return get_engine(get_postgres_url(),
+                      pool_size=int(os.getenv('OM_DB_POOL_SIZE', 5)),
+                      max_overflow=int(os.getenv('OM_DB_MAX_OVERFLOW', 10)),
+                      pool_recycle=1800,
+                      pool_pre_ping=True)
+
+
+def get_mapped_class(engine, table_name, schema='public'):
+    key = (str(engine.url), schema, table_name)
+    with _registry_lock:
+        mapped_class = _mapped_classes.get(key)
+        if mapped_class is None:
+            metadata = sqlalchemy.MetaData()
+            metadata.reflect(engine, schema=schema, only=[table_name])
+            Base = automap_base(metadata=metadata)
+            Base.prepare()
+            mapped_class = getattr(Base.classes, table_name)
+            _mapped_classes[key] = mapped_class
+        return mapped_class
+
+
+def get_session_factory(engine):
+    with _registry_lock:
+        Session = _session_factories.get(engine)
+        if Session is None:
+            Session = sqlalchemy.orm.sessionmaker(bind=engine)
+            _session_factories[engine] = Session
+        return Session
+
+
+def reset_connections():
+    """Drops the connections inherited from a parent process, to be called right after forking"""
+    with _registry_lock:
+        for engine in _engines.values():
+            engine.dispose(close=False)
+        _mongo_clients.clear()
+
+
+def prepare_tables(tables, schema='public'):
+    """Reflects the given tables up front, so the first request does not pay for it"""
+    for table in tables:
+        get_mapped_class(get_postgres_engine(), table.table_name, schema)
+
+
 class Database:
+    table_name = None
+    # Point lookups of the table by name, each a function building its statement from the mapped class
+    lookups = {}
+
     def connect(self, schema='public'):
-        raise NotImplementedError
+        self.engine = get_postgres_engine()
+        self.Table = get_mapped_class(self.engine, self.table_name, schema)
+        self.session = get_session_factory(self.engine)()
 
     def disconnect(self):
         self.session.close()
 
+    def lookup_statement(self, name):
+        """Built once per mapped class, so later calls only bind their parameters to the compiled statement"""
+        key = (self.Table, name)
+        statement = _lookup_statements.get(key)
+        if statement is None:
+            with _registry_lock:
+                statement = _lookup_statements.get(key)
+                if statement is None:
+                    statement = self.lookups[name](self.Table)
+                    _lookup_statements[key] = statement
+        return statement
+
+    def lookup(self, name, **parameters):
+        """First column of the first row of a lookup, or None, without building a DataFrame"""
+        self.connect()
+        try:
+            return self.session.execute(self.lookup_statement(name), parameters).scalar()
+        finally:
+            self.disconnect()
 
-class NotificationsTable(Database):
-
-    def connect(self, schema='public'):
-        driver = "postgresql"
-        address = os.getenv('OM_DB_ADDRESS')
-        port = os.getenv('OM_DB_PORT')
-        name = os.getenv('OM_DB_NAME')
-        user = os.getenv('OM_DB_USER')
-        password = os.getenv('OM_DB_PASSWORD')
-
-        self.engine = sqlalchemy.create_engine(f"{driver}://{user}:{password}@{address}:{port}/{name}")
 
-        metadata = sqlalchemy.MetaData()
-        metadata.reflect(self.engine, schema=schema)
-        Base = automap_base(metadata=metadata)
-        Base.prepare()
+class NotificationsTable(Database):
 
-        Session = sqlalchemy.orm.sessionmaker(bind=self.engine)
-        self.session = Session()
-        self.Table = Base.classes.notifications
+    table_name = "notifications"
 
-    def read_active_notifications(self, datetime):
+    def read_all_notifications(self):
         self.connect()
-        query = self.session.query(self.Table).filter(self.Table.starting_date < datetime)
-        query = query.filter(sqlalchemy.or_(self.Table.ending_date >= datetime, self.Table.ending_date.is_(None)))
+        query = self.session.query(self.Table)
         data = pandas.read_sql(query.statement, query.session.bind)
         self.disconnect()
-        return data
+        return data.to_dict('records')
 
 
 class UsersTable(Database):
 
-    def connect(self, schema='public'):
-        driver = "postgresql"
-        address = os.getenv('OM_DB_ADDRESS')
-        port = os.getenv('OM_DB_PORT')
-        name = os.getenv('OM_DB_NAME')
-        user = os.getenv('OM_DB_USER')
-        password = os.getenv('OM_DB_PASSWORD')
-
-        self.engine = sqlalchemy.create_engine(f"{driver}://{user}:{password}@{address}:{port}/{name}")
-
-        metadata = sqlalchemy.MetaData()
-        metadata.reflect(self.engine, schema=schema)
-        Base = automap_base(metadata=metadata)
-        Base.prepare()
+    table_name = "users"
 
-        Session = sqlalchemy.orm.sessionmaker(bind=self.engine)
-        self.session = Session()
-        self.Table = Base.classes.users
+    lookups = {
+        "username_exists": lambda Table: sqlalchemy.select(sqlalchemy.exists().where(Table.username == sqlalchemy.bindparam("username"))),
+        "email_exists": lambda Table: sqlalchemy.select(sqlalchemy.exists().where(Table.email == sqlalchemy.bindparam("email"))),
+        "id_by_username": lambda Table: sqlalchemy.select(Table.id).where(Table.username == sqlalchemy.bindparam("username")).limit(1),
+        "id_by_id": lambda Table: sqlalchemy.select(Table.id).where(Table.id == sqlalchemy.bindparam("user_id")).limit(1),
+        "password_by_username": lambda Table: sqlalchemy.select(Table.password).where(Table.username == sqlalchemy.bindparam("username")).limit(1),
+        "username_by_id": lambda Table: sqlalchemy.select(Table.username).where(Table.id == sqlalchemy.bindparam("user_id")).limit(1),
+    }
 
     def username_exists(self, username):
-        self.connect()
-        query = self.session.query(self.Table).filter(self.Table.username == username)
-        data = pandas.read_sql(query.statement, query.session.bind)
-        self.disconnect()
-        return not data.empty
+        return bool(self.lookup("username_exists", username=username))
 
     def email_exists(self, email):
-        self.connect()
-        query = self.session.query(self.Table).filter(self.Table.email == email)
-        data = pandas.read_sql(query.statement, query.session.bind)
-        self.disconnect()
-        return not data.empty
+        return bool(self.lookup("email_exists", email=email))
 
     def get_user_id(self, username=None, user_id=None):
-        self.connect()
         if username is not None:
-            query = self.session.query(self.Table).filter(self.Table.username == username)
-        else:
-            query = self.session.query(self.Table).filter(self.Table.id == user_id)
-        data = pandas.read_sql(query.statement, query.session.bind)
-        user_id = None if data.empty else data.iloc[0]['id']
-        self.disconnect()
-        return user_id
+            return self.lookup("id_by_username", username=username)
+        return self.lookup("id_by_id", user_id=user_id)
 
     def check_password(self, username, password):
-        self.connect()
-        query = self.session.query(self.Table).filter(self.Table.username == username)
-        data = pandas.read_sql(query.statement, query.session.bind)
-        hashed_password = None if data.empty else data.iloc[0]['password']
-        match = bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
-        self.disconnect()
-        return match
+        hashed_password = self.lookup("password_by_username", username=username)
+        if hashed_password is None:
+            return False
+        return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
 
     def get_username(self, user_id):
-        self.connect()
-        query = self.session.query(self.Table).filter(self.Table.id == user_id)
-        data = pandas.read_sql(query.statement, query.session.bind)
-        username = None if data.empty else data.iloc[0]['username']
-        self.disconnect()
-        return username
+        return self.lookup("username_by_id", user_id=user_id)
 
     def update_user(self, user_id, username, password, email):
         self.connect()
@@ -277,24 +340,7 @@ class UsersTable(Database):
 
 class BugReportsTable(Database):
 
-    def connect(self, schema='public'):
-        driver = "postgresql"
-        address = os.getenv('OM_DB_ADDRESS')
-        port = os.getenv('OM_DB_PORT')
-        name = os.getenv('OM_DB_NAME')
-        user = os.getenv('OM_DB_USER')
-        password = os.getenv('OM_DB_PASSWORD')
-
-        self.engine = sqlalchemy.create_engine(f"{driver}://{user}:{password}@{address}:{port}/{name}")
-
-        metadata = sqlalchemy.MetaData()
-        metadata.reflect(self.engine, schema=schema)
-        Base = automap_base(metadata=metadata)
-        Base.prepare()
-
-        Session = sqlalchemy.orm.sessionmaker(bind=self.engine)
-        self.session = Session()
-        self.Table = Base.classes.bug_reports
+    table_name = "bug_reports"
 
     def report_bug(self, username, user_data, user_information):
         self.connect()
@@ -313,18 +359,43 @@ class BugReportsTable(Database):
         return bug_report_id
 
 
+def get_mongo_client(url):
+    with _registry_lock:
+        client = _mongo_clients.get(url)
+        if client is None:
+            client = MongoClient(url,
+                                 maxPoolSize=int(os.getenv('OM_MONGO_POOL_SIZE', 50)),
+                                 connect=False)
+            _mongo_clients[url] = client
+        return client
+
+
 class DataTable(Database):
+    # Timestamps are only used for bookkeeping, so listings never send them over the wire
+    listing_projection = {'created_at': False, 'updated_at': False, 'deleted_at': False}
+    default_page_size = 100
+
+    def __init__(self, client=None):
+        # Any pymongo compatible client can be given, e.g. a mongomock one in tests
+        self.client = client
 
     def connect(self, schema='public'):
-        driver = os.getenv('OM_DB_DRIVER')
-        address = os.getenv('OM_DB_ADDRESS')
-        user = os.getenv('OM_DB_USER')
-        password = os.getenv('OM_DB_PASSWORD')
+        if self.client is None:
+            driver = os.getenv('OM_DB_DRIVER')
+            address = os.getenv('OM_DB_ADDRESS')
+            user = os.getenv('OM_DB_USER')
+            password = os.getenv('OM_DB_PASSWORD')
 
-        self.session = MongoClient(f"{driver}://{user}:{password}@{address}/")
+            self.session = get_mongo_client(f"{driver}://{user}:{password}@{address}/")
+        else:
+            self.session = self.client
 
         self.database = self.get_table()
 
+    def disconnect(self):
+        # The client is shared by the whole process and keeps its connection pool open
+        pass
+
     def get_table(self):
         raise NotImplementedError
 
@@ -358,17 +429,38 @@ class DataTable(Database):
     def get_data_by_id(self, username, id):
         self.connect()
         _id = ObjectId(id)
-        data_read = pandas.DataFrame(self.database[username].find({"_id": _id}))
+        data_read = pandas.DataFrame(self.database[username].find({"_id": _id}, self.listing_projection))
         return self.clean_time_columns(data_read)
 
     def get_data_by_slug(self, username, slug):
         self.connect()
-        data_read = pandas.DataFrame(self.database[username].find({"slug": slug}))
+        data_read = pandas.DataFrame(self.database[username].find({"slug": slug}, self.listing_projection))
         return self.clean_time_columns(data_read)
 
-    def get_data_by_username(self, username):
+    def find_by_username(self, username, projection=None, after_id=None, limit=None):
+        """Returns a cursor over the non deleted documents of a user, ordered by id.
+
+        Without after_id or limit every document is returned. Pages are chained by passing the id of
+        the last document read as after_id, which keeps every page an index range scan no matter how
+        many documents the user has; a page holds default_page_size documents unless limit says otherwise.
+        """
         self.connect()
-        data_read = pandas.DataFrame(self.database[username].find({'deleted_at': {"$eq": None}}))
+        query = {'deleted_at': {"$eq": None}}
+        if after_id is not None:
+            query['_id'] = {"$gt": ObjectId(after_id)}
+            if limit is None:
+                limit = self.default_page_size
+        if projection is None:
+            projection = self.listing_projection
+
+        cursor = self.database[username].find(query, projection).sort('_id', 1)
+        if limit is not None:
+            cursor = cursor.limit(limit).batch_size(limit)
+        self.disconnect()
+        return cursor
+
+    def get_data_by_username(self, username, projection=None, after_id=None, limit=None):
+        data_read = pandas.DataFrame(self.find_by_username(username, projection, after_id, limit))
         return self.clean_time_columns(data_read)
 
     # TODO Rename this here and in `get_data_by_id`, `get_data_by_slug` and `get_data_by_username`
@@ -394,98 +486,144 @@ class DataTable(Database):
                 "id": id}
 
 
-class MasTable(Database):
+MasSubtreeBase = declarative_base()
+
+
+class MasSubtree(MasSubtreeBase):
+    __tablename__ = 'mas_subtrees'
+    hash = Column(String, primary_key=True)
+    data = Column(LargeBinary)
+    created_at = Column(DateTime)
+
+
+# Parts of a MAS that repeat across documents, e.g. every snapshot of a session or every design
+# starting from the same catalog core
+mas_subtree_paths = [("inputs",), ("magnetic", "core"), ("magnetic", "coil"), ("outputs",)]
+_prepared_mas_subtree_engines = set()
+
+
+def split_mas_subtrees(mas):
+    """Returns a copy of mas with each subtree replaced by {"$subtree": hash}, and the serialized
+    subtrees by hash. The hash is of the exact content, so reading gives back the same document."""
+    if not isinstance(mas, dict):
+        return mas, {}
+    document = dict(mas)
+    subtrees = {}
+    for path in mas_subtree_paths:
+        parent = document
+        for key in path[:-1]:
+            if not isinstance(parent.get(key), dict):
+                parent = None
+                break
+            parent[key] = dict(parent[key])
+            parent = parent[key]
+        if parent is None or parent.get(path[-1]) is None:
+            continue
+        payload = json.dumps(parent[path[-1]], sort_keys=True, separators=(",", ":")).encode("utf-8")
+        subtree_hash = hashlib.blake2b(payload, digest_size=20).hexdigest()
+        subtrees[subtree_hash] = payload
+        parent[path[-1]] = {"$subtree": subtree_hash}
+    return document, subtrees
+
+
+def subtree_references(document):
+    references = []
+    for path in mas_subtree_paths:
+        value = document
+        for key in path:
+            value = value.get(key) if isinstance(value, dict) else None
+        if isinstance(value, dict) and "$subtree" in value:
+            references.append((path, value["$subtree"]))
+    return references
+
+
+def join_mas_subtrees(document, subtrees):
+    """Inverse of split_mas_subtrees, given the serialized subtrees by hash"""
+    if not isinstance(document, dict):
+        return document
+    references = subtree_references(document)
+    document = copy.deepcopy(document)
+    for path, subtree_hash in references:
+        parent = document
+        for key in path[:-1]:
+            parent = parent[key]
+        parent[path[-1]] = json.loads(subtrees[subtree_hash])
+    return document
+
+
+class MasDatabase(Database):
+    """Tables of MAS documents, which are stored with their subtrees deduplicated and compressed
+    in mas_subtrees, the rows keeping references to them"""
+    deduplicate = ast.literal_eval(os.getenv('OM_MAS_DEDUPLICATION', "True"))
 
     def connect(self, schema='public'):
-        driver = "postgresql"
-        address = os.getenv('OM_DB_ADDRESS')
-        port = os.getenv('OM_DB_PORT')
-        name = os.getenv('OM_DB_NAME')
-        user = os.getenv('OM_DB_USER')
-        password = os.getenv('OM_DB_PASSWORD')
-
-        self.engine = sqlalchemy.create_engine(f"{driver}://{user}:{password}@{address}:{port}/{name}")
-
-        metadata = sqlalchemy.MetaData()
-        metadata.reflect(self.engine, schema=schema)
-        Base = automap_base(metadata=metadata)
-        Base.prepare()
-
-        Session = sqlalchemy.orm.sessionmaker(bind=self.engine)
-        self.session = Session()
-        self.Table = Base.classes.mas
-
-    def insert_mas(self, mas):
+        super().connect(schema)
+        with _registry_lock:
+            if self.engine not in _prepared_mas_subtree_engines:
+                MasSubtreeBase.metadata.create_all(self.engine)
+                _prepared_mas_subtree_engines.add(self.engine)
+
+    def store_subtrees(self, subtrees):
+        """Sends the subtrees this process has not stored recently; the database skips those it already has"""
+        new_subtrees = {subtree_hash: payload for subtree_hash, payload in subtrees.items() if known_mas_subtrees.get(subtree_hash) is None}
+        if len(new_subtrees) == 0:
+            return []
+        now = datetime.datetime.now()
+        statement = postgresql_insert(MasSubtree.__table__).values([
+            {'hash': subtree_hash, 'data': zlib.compress(payload), 'created_at': now} for subtree_hash, payload in new_subtrees.items()
+        ]).on_conflict_do_nothing(index_elements=['hash'])
+        self.session.execute(statement)
+        return list(new_subtrees)
+
+    def remember_subtrees(self, subtree_hashes):
+        # Only once committed, or a rolled back subtree would never be sent again
+        for subtree_hash in subtree_hashes:
+            known_mas_subtrees.put(subtree_hash, True, len(subtree_hash))
+
+    def insert_mas_batch(self, rows):
+        """Inserts (mas, created_at) pairs in one multi-row INSERT and one commit"""
         self.connect()
-        data = {
-            'mas': mas,
-            'created_at': datetime.datetime.now()
-        }
-        row = self.Table(**data)
-        self.session.add(row)
-        self.session.flush()
-        mas_id = row.index
-        self.session.commit()
+        try:
+            documents = []
+            subtrees = {}
+            for mas, created_at in rows:
+                if self.deduplicate:
+                    mas, mas_subtrees = split_mas_subtrees(mas)
+                    subtrees.update(mas_subtrees)
+                documents.append({'mas': mas, 'created_at': created_at})
+            stored = self.store_subtrees(subtrees)
+            self.session.execute(self.Table.__table__.insert(), documents)
+            self.session.commit()
+            self.remember_subtrees(stored)
+        finally:
+            self.disconnect()
+
+    def read_mas(self, mas_id):
+        """The document as it was inserted, with its subtrees put back"""
+        self.connect()
+        document = self.session.query(self.Table.mas).filter(self.Table.index == mas_id).scalar()
+        references = subtree_references(document) if isinstance(document, dict) else []
+        subtrees = {}
+        if len(references) > 0:
+            query = self.session.query(MasSubtree.hash, MasSubtree.data).filter(MasSubtree.hash.in_([subtree_hash for _, subtree_hash in references]))
+            subtrees = {subtree_hash: zlib.decompress(data) for subtree_hash, data in query}
         self.disconnect()
-        return mas_id
+        return join_mas_subtrees(document, subtrees)
 
 
-class IntermediateMasTable(Database):
+class MasTable(MasDatabase):
 
-    def connect(self, schema='public'):
-        driver = "postgresql"
-        address = os.getenv('OM_DB_ADDRESS')
-        port = os.getenv('OM_DB_PORT')
-        name = os.getenv('OM_DB_NAME')
-        user = os.getenv('OM_DB_USER')
-        password = os.getenv('OM_DB_PASSWORD')
-
-        self.engine = sqlalchemy.create_engine(f"{driver}://{user}:{password}@{address}:{port}/{name}")
+    table_name = "mas"
 
-        metadata = sqlalchemy.MetaData()
-        metadata.reflect(self.engine, schema=schema)
-        Base = automap_base(metadata=metadata)
-        Base.prepare()
 
-        Session = sqlalchemy.orm.sessionmaker(bind=self.engine)
-        self.session = Session()
-        self.Table = Base.classes.intermediate_mas
+class IntermediateMasTable(MasDatabase):
 
-    def insert_mas(self, mas):
-        self.connect()
-        data = {
-            'mas': mas,
-            'created_at': datetime.datetime.now()
-        }
-        row = self.Table(**data)
-        self.session.add(row)
-        self.session.flush()
-        mas_id = row.index
-        self.session.commit()
-        self.disconnect()
-        return mas_id
+    table_name = "intermediate_mas"
 
 
 class AdvancedCoreMaterialsTable(Database):
 
-    def connect(self, schema='public'):
-        driver = "postgresql"
-        address = os.getenv('OM_DB_ADDRESS')
-        port = os.getenv('OM_DB_PORT')
-        name = os.getenv('OM_DB_NAME')
-        user = os.getenv('OM_DB_USER')
-        password = os.getenv('OM_DB_PASSWORD')
-
-        self.engine = sqlalchemy.create_engine(f"{driver}://{user}:{password}@{address}:{port}/{name}")
-
-        metadata = sqlalchemy.MetaData()
-        metadata.reflect(self.engine, schema=schema)
-        Base = automap_base(metadata=metadata)
-        Base.prepare()
-
-        Session = sqlalchemy.orm.sessionmaker(bind=self.engine)
-        self.session = Session()
-        self.Table = Base.classes.advanced_core_materials
+    table_name = "advanced_core_materials"
 
     def read_material_by_name(self, material_name):
         self.connect()
@@ -494,59 +632,668 @@ class AdvancedCoreMaterialsTable(Database):
         self.disconnect()
         return data.to_dict('records')[0]
 
+    def read_all_materials(self):
+        self.connect()
+        query = self.session.query(self.Table)
+        data = pandas.read_sql(query.statement, query.session.bind)
+        self.disconnect()
+        return {material["name"]: material for material in data.to_dict('records')}
+
+
+def content_version(value):
+    return hashlib.blake2b(json.dumps(value, sort_keys=True, default=str).encode("utf-8"), digest_size=16).hexdigest()
 
-class PlotCacheTable(Database):
-    def connect(self):
-        self.engine = sqlalchemy.create_engine("sqlite:////cache/cache.db", isolation_level="AUTOCOMMIT")
 
-        Base = declarative_base()
+Snapshot = collections.namedtuple("Snapshot", ["value", "version", "modified_at"])
 
-        class PlotCache(Base):
-            __tablename__ = 'plot_cache'
-            hash = Column(String, primary_key=True)
-            data = Column(String)
-            created_at = Column(String)
 
-        # Create all tables in the engine
-        Base.metadata.create_all(self.engine)
+class TableSnapshot:
+    """Whole contents of a rarely changing table, kept in memory and loaded again once they are ttl
+    seconds old or invalidated. modified_at only moves when a load brings different contents.
 
-        metadata = sqlalchemy.MetaData()
-        metadata.reflect(self.engine, )
-        Base = automap_base(metadata=metadata)
-        Base.prepare()
+    If loading again fails the old contents keep being served, and the load is retried after
+    retry_after seconds. Each process keeps its own snapshot.
+    """
 
-        Session = sqlalchemy.orm.sessionmaker(bind=self.engine)
-        self.session = Session()
-        self.Table = Base.classes.plot_cache
+    def __init__(self, name, load, ttl, retry_after=10):
+        self.name = name
+        self.load = load
+        self.ttl = ttl
+        self.retry_after = retry_after
+        self.snapshot = None
+        self.loaded_at = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.loads = 0
+        self.failures = 0
+
+    def fresh(self):
+        loaded_at = self.loaded_at
+        return loaded_at is not None and time.monotonic() - loaded_at < self.ttl
+
+    def peek(self):
+        """The snapshot if it does not need loading again, None otherwise"""
+        if not self.fresh():
+            return None
+        with self.lock:
+            self.hits += 1
+        return self.snapshot
+
+    def get(self):
+        snapshot = self.peek()
+        if snapshot is not None:
+            return snapshot
+        with self.lock:
+            # Another thread may have loaded it while this one waited
+            if self.fresh():
+                self.hits += 1
+                return self.snapshot
+            try:
+                value = self.load()
+            except Exception as e:
+                self.failures += 1
+                if self.snapshot is None:
+                    raise
+                print(f"Could not load {self.name} again, serving the copy from {self.snapshot.modified_at}: {e}")
+                self.loaded_at = time.monotonic() - self.ttl + min(self.retry_after, self.ttl)
+                return self.snapshot
+            version = content_version(value)
+            if self.snapshot is not None and self.snapshot.version == version:
+                modified_at = self.snapshot.modified_at
+            else:
+                modified_at = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+            self.snapshot = Snapshot(value, version, modified_at)
+            self.loaded_at = time.monotonic()
+            self.loads += 1
+            return self.snapshot
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded_at = None
+
+    def stats(self):
+        with self.lock:
+            return {
+                "ttl": self.ttl,
+                "age": time.monotonic() - self.loaded_at if self.loaded_at is not None else None,
+                "version": self.snapshot.version if self.snapshot is not None else None,
+                "modified_at": self.snapshot.modified_at if self.snapshot is not None else None,
+                "hits": self.hits,
+                "loads": self.loads,
+                "failures": self.failures,
+            }
+
+
+def as_utc(moment):
+    """Naive times are local, as the datetime.now() the notifications were compared with in the query"""
+    return pandas.Timestamp(moment).to_pydatetime().astimezone(datetime.timezone.utc)
+
+
+def select_active_notifications(notifications, now):
+    """The notifications shown at now, and the last time that selection changed"""
+    now = as_utc(now)
+    active = []
+    changed_at = None
+    for notification in notifications:
+        if pandas.isnull(notification["starting_date"]):
+            continue
+        starting_date = as_utc(notification["starting_date"])
+        if starting_date >= now:
+            continue
+        ending_date = None if pandas.isnull(notification["ending_date"]) else as_utc(notification["ending_date"])
+        if ending_date is None or ending_date >= now:
+            active.append(notification)
+            boundary = starting_date
+        else:
+            boundary = ending_date
+        if changed_at is None or boundary > changed_at:
+            changed_at = boundary
+    return active, changed_at
+
+
+notifications_snapshot = TableSnapshot("notifications", lambda: NotificationsTable().read_all_notifications(),
+                                       float(os.getenv('OM_NOTIFICATIONS_TTL', 60)))
+advanced_core_materials_snapshot = TableSnapshot("advanced_core_materials", lambda: AdvancedCoreMaterialsTable().read_all_materials(),
+                                                 float(os.getenv('OM_ADVANCED_CORE_MATERIALS_TTL', 600)))
+
+
+PlotCacheBase = declarative_base()
+
+
+class PlotCache(PlotCacheBase):
+    __tablename__ = 'plot_cache'
+    hash = Column(String, primary_key=True)
+    data = Column(String)
+    created_at = Column(String)
+    last_accessed_at = Column(Float, index=True)
+    size = Column(Integer)
+    blob = Column(LargeBinary)
+    content_type = Column(String)
+    encoding = Column(String)
+
+
+class FailedRender(PlotCacheBase):
+    __tablename__ = 'failed_renders'
+    hash = Column(String, primary_key=True)
+    reason = Column(String)
+    failures = Column(Integer)
+    short_circuits = Column(Integer)
+    failed_at = Column(Float)
+    expires_at = Column(Float, index=True)
+
+
+class PrewarmedShape(PlotCacheBase):
+    __tablename__ = 'prewarmed_shapes'
+    name = Column(String, primary_key=True)
+    fingerprint = Column(String)
+    rendered = Column(Integer)
+    failed = Column(Integer)
+    prewarmed_at = Column(Float)
+
+
+class Artifact:
+    """A cached result, kept compressed exactly as it is sent to the clients"""
+
+    def __init__(self, blob, content_type, encoding="identity"):
+        self.blob = blob
+        self.content_type = content_type
+        self.encoding = encoding
+
+    @classmethod
+    def compress(cls, data, content_type):
+        return cls(gzip.compress(data, compresslevel=6, mtime=0), content_type, "gzip")
+
+    def decode(self):
+        if self.encoding == "gzip":
+            return gzip.decompress(self.blob)
+        return self.blob
+
+    def text(self):
+        return self.decode().decode("utf-8")
+
+
+class MemoryLRU:
+    """Least recently used store bounded by the total size of its values, in bytes"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.items.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= previous[1]
+            self.items[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.items.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.items),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+# Subtrees this process already stored, which are not sent to the database again; sized by the length of their hashes
+known_mas_subtrees = MemoryLRU(int(os.getenv('OM_KNOWN_MAS_SUBTREES_BYTES', 4 * 1024 ** 2)))
+
+
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    # WAL lets readers in other workers go on while one of them writes
+    cursor = dbapi_connection.cursor()
+    # Only takes effect on a new file, before its first table; older files are converted by compact_plots.py --full
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+
+_prepared_plot_cache_engines = set()
+
+
+class LocalCacheDatabase(Database):
+    """Tables of the SQLite file shared by the API and the workers of one box"""
+    url = "sqlite:////cache/cache.db"
+    mapped_class = None
 
-    def insert_plot(self, hash, data):
+    def connect(self):
+        self.engine = get_engine(self.url, isolation_level="AUTOCOMMIT")
+
+        with _registry_lock:
+            if self.engine not in _prepared_plot_cache_engines:
+                if not sqlalchemy.event.contains(self.engine, "connect", configure_sqlite_connection):
+                    sqlalchemy.event.listen(self.engine, "connect", configure_sqlite_connection)
+                # Create all tables in the engine
+                PlotCacheBase.metadata.create_all(self.engine)
+                self.add_missing_columns()
+                _prepared_plot_cache_engines.add(self.engine)
+
+        self.session = get_session_factory(self.engine)()
+        self.Table = self.mapped_class
+
+    def add_missing_columns(self):
+        # Caches created before these columns existed are upgraded in place
+        existing_columns = [column['name'] for column in sqlalchemy.inspect(self.engine).get_columns('plot_cache')]
+        with self.engine.connect() as connection:
+            if 'last_accessed_at' not in existing_columns:
+                connection.execute(sqlalchemy.text("ALTER TABLE plot_cache ADD COLUMN last_accessed_at FLOAT"))
+                connection.execute(sqlalchemy.text("CREATE INDEX IF NOT EXISTS ix_plot_cache_last_accessed_at ON plot_cache (last_accessed_at)"))
+            if 'size' not in existing_columns:
+                connection.execute(sqlalchemy.text("ALTER TABLE plot_cache ADD COLUMN size INTEGER"))
+                connection.execute(sqlalchemy.text("UPDATE plot_cache SET size = length(data), last_accessed_at = 0"))
+            for column in ['blob BLOB', 'content_type VARCHAR', 'encoding VARCHAR']:
+                if column.split()[0] not in existing_columns:
+                    connection.execute(sqlalchemy.text(f"ALTER TABLE plot_cache ADD COLUMN {column}"))
+
+
+class PlotCacheTable(LocalCacheDatabase):
+    mapped_class = PlotCache
+    max_bytes = int(os.getenv('OM_PLOT_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+    # Fraction of max_bytes the disk tier is trimmed down to once it overflows
+    low_watermark = 0.9
+    # Eviction needs a SUM over the table, so the size is only checked every so many inserts
+    size_check_interval = 50
+    # Refreshing the access time costs a write, so it is only done if it is older than this, in seconds
+    access_resolution = 60
+    # Free pages given back to the filesystem after an eviction; the ones left are reused by later inserts
+    vacuum_pages = int(os.getenv('OM_PLOT_CACHE_VACUUM_PAGES', 4096))
+    memory = MemoryLRU(int(os.getenv('OM_PLOT_CACHE_MEMORY_BYTES', 64 * 1024 ** 2)))
+    counters = {"hits": 0, "misses": 0, "evictions": 0, "compactions": 0}
+    # Reads and inserts run on several threads of the API
+    counters_lock = threading.Lock()
+    inserts_since_size_check = 0
+
+    @classmethod
+    def count(cls, name, amount=1):
+        with cls.counters_lock:
+            PlotCacheTable.counters[name] += amount
+
+    def insert_artifact(self, hash, data, content_type):
+        """Compresses and stores the bytes of a result, returning the stored artifact"""
+        artifact = Artifact.compress(data, content_type)
+        self.memory.put(hash, artifact, len(artifact.blob))
         try:
             self.connect()
         except sqlalchemy.exc.OperationalError:
-            return False
+            return artifact
+        now = time.time()
         data = {
             'hash': hash,
-            'data': data,
+            'data': None,
+            'blob': artifact.blob,
+            'content_type': artifact.content_type,
+            'encoding': artifact.encoding,
             'created_at': datetime.datetime.now(),
+            'last_accessed_at': now,
+            'size': len(artifact.blob),
         }
-        row = self.Table(**data)
-        self.session.add(row)
-        self.session.flush()
+        statement = sqlite_insert(self.Table).values(**data)
+        statement = statement.on_conflict_do_update(index_elements=['hash'],
+                                                    set_={key: statement.excluded[key] for key in ['data', 'blob', 'content_type', 'encoding', 'last_accessed_at', 'size']})
+        # A locked or full disk tier only costs the entry, the result is still returned
+        try:
+            self.session.execute(statement)
+            self.session.commit()
+
+            PlotCacheTable.inserts_since_size_check += 1
+            if PlotCacheTable.inserts_since_size_check >= self.size_check_interval:
+                PlotCacheTable.inserts_since_size_check = 0
+                self.evict()
+        except sqlalchemy.exc.OperationalError as e:
+            self.session.rollback()
+            print(f"Could not store {hash} in the plot cache: {e}")
+        finally:
+            self.disconnect()
+        return artifact
+
+    def read_artifact(self, hash):
+        artifact = self.memory.get(hash)
+        if artifact is not None:
+            return artifact
+
+        try:
+            self.connect()
+        except sqlalchemy.exc.OperationalError:
+            return None
+        query = self.session.query(self.Table.data, self.Table.blob, self.Table.content_type, self.Table.encoding, self.Table.last_accessed_at)
+        query = query.filter(self.Table.hash == hash)
+        try:
+            row = query.one()
+        except MultipleResultsFound:
+            row = None
+        except NoResultFound:
+            row = None
+        except sqlalchemy.exc.OperationalError as e:
+            # Read as a miss, the result is computed again
+            print(f"Could not read {hash} from the plot cache: {e}")
+            self.disconnect()
+            return None
+
+        if row is None:
+            artifact = None
+        elif row.blob is not None:
+            artifact = Artifact(row.blob, row.content_type, row.encoding)
+        else:
+            # Written before results were stored compressed
+            artifact = Artifact(row.data.encode("utf-8"), row.content_type)
+
+        if artifact is None:
+            PlotCacheTable.count("misses")
+        else:
+            PlotCacheTable.count("hits")
+            now = time.time()
+            if row.last_accessed_at is None or now - row.last_accessed_at > self.access_resolution:
+                try:
+                    self.session.query(self.Table).filter(self.Table.hash == hash).update({'last_accessed_at': now})
+                    self.session.commit()
+                except sqlalchemy.exc.OperationalError:
+                    # Only the eviction order suffers, it is tried again on a later read
+                    self.session.rollback()
+            self.memory.put(hash, artifact, len(artifact.blob))
+        self.disconnect()
+        return artifact
+
+    def evict(self):
+        """Drops the least recently read entries until the disk tier fits under its low watermark"""
+        total_size = self.session.query(sqlalchemy.func.coalesce(sqlalchemy.func.sum(self.Table.size), 0)).scalar()
+        if total_size <= self.max_bytes:
+            return 0
+
+        target = total_size - self.max_bytes * self.low_watermark
+        freed = 0
+        evicted = 0
+        query = self.session.query(self.Table.hash, self.Table.size).order_by(self.Table.last_accessed_at.asc())
+        hashes = []
+        for row in query.yield_per(500):
+            hashes.append(row.hash)
+            freed += row.size or 0
+            if freed >= target:
+                break
+
+        for index in range(0, len(hashes), 500):
+            chunk = hashes[index:index + 500]
+            evicted += self.session.query(self.Table).filter(self.Table.hash.in_(chunk)).delete(synchronize_session=False)
+        self.session.commit()
+        PlotCacheTable.count("evictions", evicted)
+        print(f"Evicted {evicted} plots from the cache, freeing {freed} bytes")
+
+        # Deleting rows does not give the space back to the filesystem, a bounded number of pages is
+        self.compact(self.vacuum_pages)
+        return evicted
+
+    def compact(self, pages=None):
+        """Gives up to pages free pages back to the filesystem, every free page if None.
+
+        Incremental, so it only touches the free pages and never rewrites the whole file.
+        """
+        pragma = "PRAGMA incremental_vacuum" if pages is None else f"PRAGMA incremental_vacuum({int(pages)})"
+        try:
+            with self.engine.connect() as connection:
+                # executescript steps the pragma to the end, a plain execute frees a single page
+                connection.connection.dbapi_connection.executescript(pragma)
+        except sqlite3.OperationalError as e:
+            # The pages stay free and are reused, the next eviction tries again
+            print(f"Could not compact the plot cache: {e}")
+            return
+        PlotCacheTable.count("compactions")
+
+    def vacuum(self):
+        """Rewrites the whole file, switching a cache created before incremental auto vacuum over to it.
+
+        Needs as much free disk as the file and locks out writers while it runs, so it is only run
+        by hand or from a scheduled job, never from a request or a task.
+        """
+        self.connect()
+        with self.engine.connect() as connection:
+            connection.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+            connection.exec_driver_sql("VACUUM")
+            mode = connection.exec_driver_sql("PRAGMA auto_vacuum").scalar()
+        self.disconnect()
+        return mode
+
+    def stats(self):
+        try:
+            self.connect()
+        except sqlalchemy.exc.OperationalError:
+            disk = None
+        else:
+            entries, size = self.session.query(sqlalchemy.func.count(self.Table.hash),
+                                               sqlalchemy.func.coalesce(sqlalchemy.func.sum(self.Table.size), 0)).one()
+            with PlotCacheTable.counters_lock:
+                counters = dict(PlotCacheTable.counters)
+            disk = dict(counters, entries=entries, bytes=size, max_bytes=self.max_bytes)
+            self.disconnect()
+        return {"memory": self.memory.stats(), "disk": disk}
+
+
+class FailedRendersTable(LocalCacheDatabase):
+    """Short lived record of the requests that could not be rendered, so retries of the same input
+    are answered straight away instead of reaching FreeCAD or PyMKF again"""
+    mapped_class = FailedRender
+    ttl = int(os.getenv('OM_FAILED_RENDER_TTL', 600))
+    # Rows are kept this long after they expire, for their counters
+    retention = 24 * 3600
+
+    def record_failure(self, hash, reason, ttl=None):
+        try:
+            self.connect()
+        except sqlalchemy.exc.OperationalError:
+            return False
+        now = time.time()
+        statement = sqlite_insert(self.Table).values(hash=hash, reason=reason, failures=1, short_circuits=0,
+                                                     failed_at=now, expires_at=now + (ttl or self.ttl))
+        statement = statement.on_conflict_do_update(index_elements=['hash'],
+                                                    set_={'reason': statement.excluded.reason,
+                                                          'failures': self.Table.failures + 1,
+                                                          'failed_at': statement.excluded.failed_at,
+                                                          'expires_at': statement.excluded.expires_at})
+        self.session.execute(statement)
+        self.session.query(self.Table).filter(self.Table.expires_at < now - self.retention).delete(synchronize_session=False)
         self.session.commit()
         self.disconnect()
         return True
 
-    def read_plot(self, hash):
+    def read_failure(self, hash):
+        """Returns the reason of a recent failure of this hash, or None"""
         try:
             self.connect()
         except sqlalchemy.exc.OperationalError:
             return None
-        query = self.session.query(self.Table).filter(self.Table.hash == hash)
+        query = self.session.query(self.Table).filter(self.Table.hash == hash, self.Table.expires_at > time.time())
+        updated = query.update({'short_circuits': self.Table.short_circuits + 1}, synchronize_session=False)
+        reason = None
+        if updated:
+            reason = self.session.query(self.Table.reason).filter(self.Table.hash == hash).scalar()
+        self.session.commit()
+        self.disconnect()
+        return reason
+
+    def failure_counters(self, limit=50):
         try:
-            data = query.one().data
-        except MultipleResultsFound:
-            data = None
-        except NoResultFound:
-            data = None
+            self.connect()
+        except sqlalchemy.exc.OperationalError:
+            return []
+        query = self.session.query(self.Table).order_by(self.Table.failures.desc()).limit(limit)
+        now = time.time()
+        counters = [{
+            "hash": row.hash,
+            "reason": row.reason,
+            "failures": row.failures,
+            "short_circuits": row.short_circuits,
+            "failed_at": row.failed_at,
+            "active": row.expires_at > now,
+        } for row in query]
+        self.disconnect()
+        return counters
+
+
+class PrewarmedShapesTable(LocalCacheDatabase):
+    """Catalog shapes whose artifacts are already in this box's plot cache, so a prewarm run can
+    resume where the last one stopped and skip the shapes that did not change"""
+    mapped_class = PrewarmedShape
+
+    def read_fingerprints(self):
+        try:
+            self.connect()
+        except sqlalchemy.exc.OperationalError:
+            return {}
+        fingerprints = dict(self.session.query(self.Table.name, self.Table.fingerprint))
+        self.disconnect()
+        return fingerprints
+
+    def mark_prewarmed(self, name, fingerprint, rendered, failed):
+        try:
+            self.connect()
+        except sqlalchemy.exc.OperationalError:
+            return False
+        statement = sqlite_insert(self.Table).values(name=name, fingerprint=fingerprint, rendered=rendered, failed=failed,
+                                                     prewarmed_at=time.time())
+        statement = statement.on_conflict_do_update(index_elements=['name'],
+                                                    set_={'fingerprint': statement.excluded.fingerprint,
+                                                          'rendered': statement.excluded.rendered,
+                                                          'failed': statement.excluded.failed,
+                                                          'prewarmed_at': statement.excluded.prewarmed_at})
+        self.session.execute(statement)
+        self.session.commit()
+        self.disconnect()
+        return True
+
+    def forget_all(self):
+        try:
+            self.connect()
+        except sqlalchemy.exc.OperationalError:
+            return False
+        self.session.query(self.Table).delete(synchronize_session=False)
+        self.session.commit()
+        self.disconnect()
+        return True
+
+
+RequestLogBase = declarative_base()
+
+
+class StoredRequest(RequestLogBase):
+    __tablename__ = 'requests'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    email = Column(String)
+    name = Column(String)
+    mas = Column(String)
+    created_at = Column(Float, index=True)
+
+
+_prepared_request_log_engines = set()
+
+
+class RequestLogTable(Database):
+    """Append only log of the requests users send from the web, kept apart from the caches so it is never evicted.
+
+    Every request is one INSERT, whatever the size of the log; the CSV the old endpoint rewrote is
+    imported the first time and export_requests.py writes it out on demand.
+    """
+    path = os.getenv('OM_REQUEST_LOG_PATH', '/opt/openmagnetics/requests.db')
+    legacy_csv = "/opt/openmagnetics/temp/requests.csv"
+
+    def connect(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.engine = get_engine(f"sqlite:///{self.path}", isolation_level="AUTOCOMMIT")
+
+        with _registry_lock:
+            if self.engine not in _prepared_request_log_engines:
+                if not sqlalchemy.event.contains(self.engine, "connect", configure_sqlite_connection):
+                    sqlalchemy.event.listen(self.engine, "connect", configure_sqlite_connection)
+                RequestLogBase.metadata.create_all(self.engine)
+                self.import_legacy_csv()
+                _prepared_request_log_engines.add(self.engine)
+
+        self.session = get_session_factory(self.engine)()
+        self.Table = StoredRequest
+
+    def import_legacy_csv(self):
+        """Imports the CSV the old endpoint rewrote, once.
+
+        Runs under the write lock of the log, so only one process imports it. The file is read as
+        .importing and renamed to .imported once its rows are committed. Its rows all get the time
+        the file was last written as created_at, so a process that stopped between the commit and the
+        rename finds them and the next one only renames it.
+        """
+        importing = f"{self.legacy_csv}.importing"
+        imported = f"{self.legacy_csv}.imported"
+        with self.engine.connect() as connection:
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+            try:
+                if os.path.exists(self.legacy_csv):
+                    os.rename(self.legacy_csv, importing)
+                if not os.path.exists(importing):
+                    connection.exec_driver_sql("ROLLBACK")
+                    return
+                rows = pandas.read_csv(importing, dtype=str, keep_default_na=False)
+                imported_at = os.path.getmtime(importing)
+                table = StoredRequest.__table__
+                already_imported = collections.Counter(connection.execute(
+                    sqlalchemy.select(table.c.email, table.c.mas).where(table.c.created_at == imported_at)).all())
+                new_rows = []
+                for row in rows.to_dict("records"):
+                    key = (row.get("email"), row.get("mas"))
+                    if already_imported[key] > 0:
+                        already_imported[key] -= 1
+                        continue
+                    new_rows.append({"email": key[0], "name": row.get("name"), "mas": key[1], "created_at": imported_at})
+                if len(new_rows) > 0:
+                    connection.execute(table.insert(), new_rows)
+                connection.exec_driver_sql("COMMIT")
+            except Exception as e:
+                if connection.connection.dbapi_connection.in_transaction:
+                    connection.exec_driver_sql("ROLLBACK")
+                print(f"Could not import {importing}, it is tried again next time: {e}")
+                return
+
+        print(f"Imported {len(new_rows)} requests from {self.legacy_csv}, {len(rows) - len(new_rows)} were already imported")
+        try:
+            os.rename(importing, imported)
+        except OSError as e:
+            print(f"Could not rename {importing}, its rows are skipped when it is tried again: {e}")
+
+    def append_request(self, email, name, mas):
+        self.connect()
+        self.session.execute(StoredRequest.__table__.insert().values(email=email, name=name, mas=json.dumps(mas), created_at=time.time()))
+        self.session.commit()
+        self.disconnect()
+
+    def iterate_requests(self, batch_size=1000):
+        """Yields every request in the order they arrived, without loading the whole log"""
+        self.connect()
+        last_id = 0
+        while True:
+            rows = self.session.query(self.Table).filter(self.Table.id > last_id).order_by(self.Table.id).limit(batch_size).all()
+            if len(rows) == 0:
+                break
+            for row in rows:
+                yield {"email": row.email, "name": row.name, "mas": row.mas, "created_at": row.created_at}
+            last_id = rows[-1].id
         self.disconnect()
-        return data
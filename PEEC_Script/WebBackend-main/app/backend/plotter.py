@@ -1,29 +1,200 @@
 import copy
 import sys
 import os
-import hashlib
 import PyMKF
-import time
 import ast
 import base64
+import json
+import contextlib
+import fcntl
+import pathlib
+import tempfile
+import threading
+import types
+import queue
+import time
 sys.path.append(os.path.abspath(os.path.dirname(__file__)))
 from mas_models import MagneticCore, CoreShape
 from celery import Celery
+from celery.signals import worker_init, worker_process_init, task_failure
+from kombu import Exchange, Queue
 # sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../../MVB/src/OpenMagneticsVirtualBuilder')))
 from OpenMagneticsVirtualBuilder.builder import Builder as ShapeBuilder  # noqa: E402
-from models import PlotCacheTable
-
-app = Celery('plots', backend='rpc://', broker='pyamqp://guest@localhost//')
-
-
-def purge_queue():
-    print("Purging queue")
-    app.control.purge()
+from models import PlotCacheTable, FailedRendersTable, reset_connections
+from mas_fingerprint import fingerprint, ignored_keys
+import meshes
+import numpy
+try:
+    # Its plot functions return the SVG instead of writing it to a file
+    import PyOpenMagnetics
+except ImportError:
+    PyOpenMagnetics = None
+
+app = Celery('plots', backend='rpc://', broker='pyamqp://guest@localhost//', include=['prewarm'])
+# Lets the API report jobs that a worker already picked up as running
+app.conf.task_track_started = True
+
+# Tasks are split by how long they take, so a quick wire plot never waits behind a STEP build.
+# Each class has its own queue and is served by its own workers (see BUILD.md), and inputs that
+# hang FreeCAD or PyMKF past the time limits are interrupted, which fails the task and dead-letters it.
+task_classes = {
+    "interactive": {"queue": "plots.interactive", "soft_time_limit": 20, "time_limit": 30},
+    "heavy": {"queue": "plots.heavy", "soft_time_limit": 90, "time_limit": 120},
+    "batch": {"queue": "plots.batch", "soft_time_limit": 600, "time_limit": 900},
+}
+for task_class_name, task_class in task_classes.items():
+    for option in ("soft_time_limit", "time_limit"):
+        task_class[option] = int(os.getenv(f'OM_{task_class_name.upper()}_{option.upper()}', task_class[option]))
+
+plots_exchange = Exchange("plots", type="direct")
+app.conf.task_queues = [Queue(task_class["queue"], plots_exchange, routing_key=task_class["queue"]) for task_class in task_classes.values()]
+app.conf.task_default_queue = task_classes["interactive"]["queue"]
+app.conf.task_default_exchange = plots_exchange.name
+app.conf.task_default_routing_key = task_classes["interactive"]["queue"]
+
+# No worker consumes this queue, failed tasks are parked there to be inspected or replayed. Their
+# args can be whole magnetics, so the broker keeps only the newest and drops them after a while.
+# RabbitMQ refuses to declare a queue again with other arguments, a queue declared before these
+# were set has to be deleted once (rabbitmqctl delete_queue plots.dead_letter).
+dead_letter_queue = Queue("plots.dead_letter", Exchange("plots.dead_letter", type="direct"), routing_key="plots.dead_letter",
+                          queue_arguments={
+                              "x-max-length": int(os.getenv('OM_DEAD_LETTER_MAX_LENGTH', 1000)),
+                              "x-max-length-bytes": int(os.getenv('OM_DEAD_LETTER_MAX_BYTES', 64 * 1024 ** 2)),
+                              "x-message-ttl": int(float(os.getenv('OM_DEAD_LETTER_TTL', 7 * 24 * 3600)) * 1000),
+                          })
+
+
+def task_options(task_class_name):
+    task_class = task_classes[task_class_name]
+    return {"queue": task_class["queue"], "soft_time_limit": task_class["soft_time_limit"], "time_limit": task_class["time_limit"]}
+
+
+def queue_depths():
+    """Messages waiting and workers consuming in each queue, as the broker sees them"""
+    depths = {}
+    with app.connection_for_read() as connection:
+        channel = connection.default_channel
+        for task_class_name, task_class in list(task_classes.items()) + [("dead_letter", {"queue": dead_letter_queue.name})]:
+            try:
+                _, messages, consumers = channel.queue_declare(queue=task_class["queue"], passive=True)
+            except Exception:
+                # Not declared yet, no worker for it has started
+                channel = connection.channel()
+                messages, consumers = 0, 0
+            depths[task_class_name] = {"queue": task_class["queue"], "messages": messages, "consumers": consumers}
+    return depths
+
+
+lock_folder = os.getenv('OM_LOCK_FOLDER', "/tmp/openmagnetics_locks")
+number_lock_stripes = 4096
+
+
+@task_failure.connect
+def dead_letter_failed_task(sender=None, task_id=None, exception=None, args=None, kwargs=None, **other):
+    message = {
+        "task": sender.name if sender is not None else None,
+        "task_id": task_id,
+        "args": args,
+        "kwargs": kwargs,
+        "error": repr(exception),
+        "failed_at": time.time(),
+    }
+    try:
+        with app.producer_or_acquire() as producer:
+            producer.publish(message, exchange=dead_letter_queue.exchange, routing_key=dead_letter_queue.routing_key,
+                             declare=[dead_letter_queue], serializer="json", retry=True,
+                             retry_policy={"max_retries": 3})
+    except Exception as e:
+        print(f"Could not dead-letter task {task_id}: {e}")
+
+
+@contextlib.contextmanager
+def single_flight(hash_value):
+    """Serializes the computation of a hash across threads and worker processes.
+
+    Whoever gets the lock first renders and caches the result; the rest wait for it and then find
+    it in the cache. Hashes are spread over a fixed number of lock files so they do not pile up.
+    """
+    pathlib.Path(lock_folder).mkdir(parents=True, exist_ok=True)
+    stripe = int(hash_value[:8], 16) % number_lock_stripes
+    with open(f"{lock_folder}/{stripe}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class ShapeBuilderPool:
+    """Reuses FreeCAD builders instead of creating one for every call.
+
+    FreeCAD is not thread safe, so a builder is only lent to one caller at a time, and callers
+    wait for one to be returned once the pool has created as many as its size.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.created = 0
+        self.builders = queue.LifoQueue()
+        self.lock = threading.Lock()
+
+    def warm(self):
+        with self.lock:
+            while self.created < self.size:
+                self.builders.put(ShapeBuilder("FreeCAD"))
+                self.created += 1
+
+    @contextlib.contextmanager
+    def builder(self):
+        try:
+            builder = self.builders.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                create = self.created < self.size
+                if create:
+                    self.created += 1
+            builder = ShapeBuilder("FreeCAD") if create else self.builders.get()
+        try:
+            yield builder
+        finally:
+            self.builders.put(builder)
+
+
+shape_builders = ShapeBuilderPool(int(os.getenv('OM_BUILDER_POOL_SIZE', 1)))
+families = None
+
+
+def get_families():
+    global families
+    if families is None:
+        with shape_builders.builder() as builder:
+            families = builder.get_families()
+    return families
+
+
+def warm_up():
+    """Loads what every task needs, so workers forked afterwards share it instead of loading it on their first task"""
+    shape_builders.warm()
+    get_families()
+    if PyOpenMagnetics is not None and hasattr(PyOpenMagnetics, "load_databases"):
+        PyOpenMagnetics.load_databases({})
+
+
+@worker_init.connect
+def warm_up_worker(**kwargs):
+    # Runs in the parent process, before the pool is forked
+    warm_up()
+
+
+@worker_process_init.connect
+def reset_connections_after_fork(**kwargs):
+    # Pooled database connections must not be shared with the parent
+    reset_connections()
 
 
 def clean_dimensions(core):
     # Make sure no unwanted dimension gets in
-    families = ShapeBuilder("FreeCAD").get_families()
+    families = get_families()
     if "familySubtype" in core['functionalDescription']['shape'] and core['functionalDescription']['shape']['familySubtype'] is not None:
         dimensions = families[core['functionalDescription']['shape']['family']][int(core['functionalDescription']['shape']['familySubtype'])]
     else:
@@ -36,9 +207,254 @@ def clean_dimensions(core):
     return core
 
 
-@app.task
-def task_generate_core_3d_model(core, temp_folder, stl_or_not_step=True):
-    if 'familySubtype' in core['functionalDescription']['shape']:
+# Names can end up printed in technical drawings
+named_ignored_keys = ignored_keys - {"name"}
+
+
+def hash_request(aux, kind, ignored=ignored_keys):
+    return fingerprint(aux, kind, ignored=ignored)
+
+
+def read_cached(cache, hash_value, legacy_decoder=None):
+    artifact = cache.read_artifact(hash_value)
+    if artifact is None:
+        return None
+    if artifact.content_type == "application/json":
+        return json.loads(artifact.decode())
+    if artifact.content_type is None and legacy_decoder is not None:
+        return legacy_decoder(artifact.text())
+    return artifact.text()
+
+
+def read_cached_model(cache, hash_value, content_type):
+    if content_type == "application/json":
+        return read_cached(cache, hash_value)
+    artifact = cache.read_artifact(hash_value)
+    if artifact is None or artifact.content_type != content_type:
+        return None
+    return base64.b64encode(artifact.decode()).decode('utf-8')
+
+
+cci_coordinates_path = "/opt/openmagnetics/cci_coords/coordinates/"
+painter_keys = ["painterSimpleLitz", "painterAdvancedLitz", "painterCciCoordinatesPath", "painterIncludeFringing",
+                "painterColorBobbin", "painterColorText", "painterColorLines", "painterColorMargin"]
+# Taken before any task touches the settings, so every profile starts from the same values
+default_painter_settings = {key: value for key, value in PyMKF.get_settings().items() if key in painter_keys}
+
+render_profiles = {
+    "core_fields_dark": {
+        "painterSimpleLitz": True,
+        "painterAdvancedLitz": False,
+        "painterCciCoordinatesPath": cci_coordinates_path,
+        "painterColorBobbin": "0x7F539796",
+        "painterColorText": "0xd4d4d4",
+        "painterColorLines": "0x1a1a1a",
+        "painterColorMargin": "0x7Ffff05b",
+    },
+    "core_turns": {
+        "painterSimpleLitz": True,
+        "painterAdvancedLitz": False,
+        "painterCciCoordinatesPath": cci_coordinates_path,
+    },
+    "wire_light": {
+        "painterSimpleLitz": False,
+        "painterAdvancedLitz": False,
+        "painterColorBobbin": "0x539796",
+        "painterColorMargin": "0xfff05b",
+        "painterCciCoordinatesPath": cci_coordinates_path,
+    },
+    "wire_current_density": {
+        "painterSimpleLitz": False,
+        "painterAdvancedLitz": False,
+        "painterCciCoordinatesPath": cci_coordinates_path,
+    },
+}
+
+
+def render_profile(name, **overrides):
+    """Complete, read-only painter settings of a named profile, with optional per-request overrides"""
+    profile = dict(default_painter_settings)
+    profile.update(render_profiles[name])
+    profile.update(overrides)
+    return types.MappingProxyType(profile)
+
+
+def render_failed(hash_value, reason):
+    # Remembered for a while, so retries of the same input do not reach FreeCAD or PyMKF again
+    FailedRendersTable().record_failure(hash_value, reason)
+    return None
+
+
+def cached_render(hash_value, read, render, failure_reason):
+    """Result of a task, read from the plot cache or rendered by a single worker at a time.
+
+    read(cache) returns the cached result or None. render(cache) renders, stores and returns the
+    result, or returns None if it could not be rendered, which is remembered as failure_reason.
+    """
+    cache = PlotCacheTable()
+    result = read(cache)
+    if result is not None:
+        print("Hit in cache!")
+        return result
+
+    with single_flight(hash_value):
+        result = read(cache)
+        if result is not None:
+            print("Hit in cache after waiting for another worker!")
+            return result
+
+        reason = FailedRendersTable().read_failure(hash_value)
+        if reason is not None:
+            print(f"Known failure, not rendering again: {reason}")
+            return None
+
+        result = render(cache)
+        if result is None:
+            return render_failed(hash_value, failure_reason)
+        return result
+
+
+def store_svg(cache, hash_value, svg):
+    if svg is None:
+        return None
+    cache.insert_artifact(hash_value, svg, "image/svg+xml")
+    return svg.decode("utf-8")
+
+
+def store_views(cache, hash_value, views):
+    if views['top_view'] is None or views['front_view'] is None:
+        return None
+    cache.insert_artifact(hash_value, json.dumps(views).encode("utf-8"), "application/json")
+    return views
+
+
+def set_painter_settings(changes):
+    settings = PyMKF.get_settings()
+    settings.update(changes)
+    PyMKF.set_settings(settings)
+    if PyOpenMagnetics is not None:
+        settings = PyOpenMagnetics.get_settings()
+        settings.update(changes)
+        PyOpenMagnetics.set_settings(settings)
+
+
+class RenderSettings:
+    """Scopes the global PyMKF painter settings to the renders that need them.
+
+    Renders that use the profile currently applied run concurrently; one that needs a different
+    profile waits until they finish before applying it, so settings never change under a running
+    render and nothing carries over from one task to the next. Once a render is waiting for another
+    profile no more renders of the current one are let in, and when the running ones finish the
+    profile of the longest waiting render goes next, so a steady stream of one profile cannot starve
+    the others.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.active_profile = None
+        self.renders = 0
+        # Profiles of the waiting renders, oldest first
+        self.waiting = []
+
+    def must_wait(self, profile):
+        if self.renders > 0:
+            return self.active_profile != profile or any(other != profile for other in self.waiting)
+        return self.waiting[0] != profile
+
+    @contextlib.contextmanager
+    def apply(self, profile):
+        with self.condition:
+            self.waiting.append(profile)
+            try:
+                while self.must_wait(profile):
+                    self.condition.wait()
+            finally:
+                self.waiting.remove(profile)
+            if self.active_profile != profile:
+                set_painter_settings(profile)
+                self.active_profile = profile
+            self.renders += 1
+            # The other renders waiting for this profile can come in too
+            self.condition.notify_all()
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.renders -= 1
+                if self.renders == 0:
+                    self.condition.notify_all()
+
+
+render_settings = RenderSettings()
+
+
+def render_svg(temp_folder, plot_to_file, plot_in_memory=None):
+    """Renders a plot and returns the bytes of its SVG, or None if it could not be drawn.
+
+    The in-memory renderer is used when available. Otherwise the plot is drawn into a private
+    temporary folder, which is read once the synchronous call returns and then removed, so no
+    polling is needed and two renders of the same plot do not share a file.
+    """
+    if PyOpenMagnetics is not None and plot_in_memory is not None:
+        try:
+            result = plot_in_memory()
+        except (AttributeError, TypeError) as e:
+            print(f"In-memory plotting not available: {e}")
+        else:
+            if isinstance(result, dict) and result.get('success', False):
+                return result['svg'].encode("utf-8")
+            print(f"In-memory plotting failed: {result.get('error') if isinstance(result, dict) else result}")
+
+    pathlib.Path(temp_folder).mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=temp_folder) as folder:
+        path = f"{folder}/plot.svg"
+        plot_to_file(path)
+        if not os.path.exists(path) or os.stat(path).st_size == 0:
+            return None
+        with open(path, "rb") as svg:
+            return svg.read()
+
+
+# Formats a 3D model can be returned in: base64 text inside JSON, as the frontend always got it,
+# or the bytes themselves, with STL meshes also available as quantized indexed GLB
+core_3d_model_formats = {
+    True: {"json": "application/json", "stl": "model/stl", "glb": "model/gltf-binary"},
+    False: {"json": "application/json", "step": "model/step"},
+}
+# Levels of detail of STL meshes: 0 is what FreeCAD wrote, the others merge the vertices closer
+# than this fraction of the biggest side of the core
+core_3d_model_lods = {0: None, 1: 0.01, 2: 0.025}
+
+
+def core_3d_model_kind(stl_or_not_step=True, model_format="json", lod=0):
+    """Name of a format and level of detail of the 3D models, used for their cache keys and their jobs"""
+    kind = "core_3d_model_stl" if stl_or_not_step else "core_3d_model_stp"
+    if model_format != "json":
+        kind = f"{kind}_{model_format}"
+    if lod != 0:
+        kind = f"{kind}_lod{lod}"
+    return kind
+
+
+def core_3d_model_geometry(core):
+    """What a 3D model is built from: the pieces of the geometrical description, without their materials"""
+    pieces = core.get('geometricalDescription')
+    if pieces is None:
+        return None
+    return [{key: value for key, value in piece.items() if key not in ("material", "insulationMaterial")} for piece in pieces]
+
+
+def core_3d_model_hash(core, stl_or_not_step=True, model_format="json", lod=0):
+    geometry = core_3d_model_geometry(core)
+    # Keyed on the geometry, so cores of any material and processed data share the model of their shape
+    aux = {"geometry": geometry} if geometry is not None else {"core": core}
+    return hash_request(aux, core_3d_model_kind(stl_or_not_step, model_format, lod))
+
+
+def prepare_core_3d_model(core, stl_or_not_step=True, model_format="json", lod=0):
+    core = copy.deepcopy(core)
+    # Calculated catalog shapes come with a null subtype, which would become "None"
+    if core['functionalDescription']['shape'].get('familySubtype') is not None:
         core['functionalDescription']['shape']['familySubtype'] = str(core['functionalDescription']['shape']['familySubtype'])
 
     core = MagneticCore(**core)
@@ -49,278 +465,370 @@ def task_generate_core_3d_model(core, temp_folder, stl_or_not_step=True):
         core['functionalDescription']['material'] = core['functionalDescription']['material']['name']
 
     # pprint.pprint(core)
-    aux = {
-        "core": core,
-    }
-    hash_value = hashlib.sha256(str(aux).encode()).hexdigest()
-    cache = PlotCacheTable()
+    return core_3d_model_hash(core, stl_or_not_step, model_format, lod), core
 
-    cached_datum = cache.read_plot(hash_value)
-    if cached_datum is not None:
-        print("Hit in cache!")
-        return cached_datum
 
-    step_path, stl_path = ShapeBuilder("FreeCAD").get_core(project_name=hash_value,
-                                                           geometrical_description=core['geometricalDescription'],
-                                                           output_path=f"{temp_folder}/cores")
-    path = stl_path if stl_or_not_step else step_path
-
-    print(path)
-    if path is None:
-        return None
+def prepare_core_shape(coreShape, stl_or_not_step=True):
+    coreShape = copy.deepcopy(coreShape)
+    if 'familySubtype' in coreShape:
+        coreShape['familySubtype'] = str(coreShape['familySubtype'])
 
-    with open(path, "rb") as stl:
-        data = stl.read()
-        data = base64.b64encode(data).decode('utf-8')
-        cache.insert_plot(hash_value, data)
-        return data
+    coreShape = CoreShape(**coreShape).dict()
+    aux = {
+        "coreShape": coreShape,
+    }
+    return hash_request(aux, "core_shape_stl" if stl_or_not_step else "core_shape_stp"), coreShape
 
 
-@app.task
-def task_plot_core_and_fields(data, temp_folder):
+def prepare_plot_core_and_fields(data):
     aux = {
         "magnetic": data["magnetic"],
         "operatingPoint": data["operatingPoint"],
         "includeFringing": data["includeFringing"],
     }
-    hash_value = hashlib.sha256(str(aux).encode()).hexdigest()
-    cache = PlotCacheTable()
+    return hash_request(aux, "plot_core_and_fields"), data
 
-    cached_datum = cache.read_plot(hash_value)
-    if cached_datum is not None:
-        print("Hit in cache!")
-        return cached_datum
 
-    settings = PyMKF.get_settings()
-    settings["painterSimpleLitz"] = True
-    settings["painterAdvancedLitz"] = False
-    settings["painterCciCoordinatesPath"] = "/opt/openmagnetics/cci_coords/coordinates/"
-    settings["painterIncludeFringing"] = data["includeFringing"]
-    settings["painterColorBobbin"] = "0x7F539796"
-    settings["painterColorText"] = "0xd4d4d4"
-    settings["painterColorLines"] = "0x1a1a1a"
-    settings["painterColorMargin"] = "0x7Ffff05b"
-    PyMKF.set_settings(settings)
-    result = PyMKF.plot_field(data["magnetic"], data["operatingPoint"], f"{temp_folder}/{hash_value}.svg")
-
-    timeout = 0
-    current_size = 0
-    while not os.path.exists(f"{temp_folder}/{hash_value}.svg"):
-        time.sleep(0.01)
-        timeout += 1
-        if timeout == 200:
-            return None
+def prepare_plot_core(data):
+    aux = {
+        "magnetic": data["magnetic"]
+    }
+    return hash_request(aux, "plot_core"), data
 
-    timeout = 0
-    while os.stat(f"{temp_folder}/{hash_value}.svg").st_size == 0 or current_size != os.stat(f"{temp_folder}/{hash_value}.svg").st_size:
-        current_size = os.stat(f"{temp_folder}/{hash_value}.svg").st_size
-        time.sleep(0.01)
-        timeout += 1
-        print(timeout)
-        if timeout == 1000:
-            return None
 
-    with open(f"{temp_folder}/{hash_value}.svg", "rb") as svg:
-        cache.insert_plot(hash_value, svg.read().decode("utf-8"))
+def prepare_plot_wire(data):
+    aux = {
+        "wire": data["wire"]
+    }
+    return hash_request(aux, "plot_wire"), data
+
+
+def prepare_plot_wire_and_current_density(data):
+    aux = {
+        "wire": data["wire"],
+        "operatingPoint": data["operatingPoint"],
+    }
+    return hash_request(aux, "plot_wire_and_current_density"), data
 
-    return f"{temp_folder}/{hash_value}.svg"
 
+def prepare_core_technical_drawing(data):
+    data = copy.deepcopy(data)
+    if 'familySubtype' in data:
+        data['familySubtype'] = str(data['familySubtype'])
 
-@app.task
-def task_plot_core(data, temp_folder):
+    coreShape = CoreShape(**data)
+    coreShape = coreShape.dict()
     aux = {
-        "magnetic": data["magnetic"]
+        "coreShape": coreShape,
     }
-    hash_value = hashlib.sha256(str(aux).encode()).hexdigest()
-    cache = PlotCacheTable()
+    return hash_request(aux, "core_technical_drawing", named_ignored_keys), coreShape
 
-    cached_datum = cache.read_plot(hash_value)
-    if cached_datum is not None:
-        print("Hit in cache!")
-        return cached_datum
 
-    settings = PyMKF.get_settings()
-    settings["painterSimpleLitz"] = True
-    settings["painterAdvancedLitz"] = False
-    settings["painterCciCoordinatesPath"] = "/opt/openmagnetics/cci_coords/coordinates/"
-    PyMKF.set_settings(settings)
-    PyMKF.plot_turns(data["magnetic"], f"{temp_folder}/{hash_value}.svg")
-
-    timeout = 0
-    current_size = 0
-    while not os.path.exists(f"{temp_folder}/{hash_value}.svg"):
-        time.sleep(0.01)
-        timeout += 1
-        if timeout == 200:
+def prepare_gapping_technical_drawing(data):
+    data = copy.deepcopy(data)
+    if 'familySubtype' in data['functionalDescription']['shape']:
+        data['functionalDescription']['shape']['familySubtype'] = str(data['functionalDescription']['shape']['familySubtype'])
+
+    core = MagneticCore(**data)
+    core = core.dict()
+    aux = {
+        "core": core,
+    }
+    return hash_request(aux, "gapping_technical_drawing", named_ignored_keys), core
+
+
+def build_core_model(geometrical_description, temp_folder, project_name, stl_or_not_step=True):
+    """Builds the pieces in FreeCAD, returning the bytes of the STL or STEP file, or None if they could not be built"""
+    # FreeCAD output is only needed until it is cached, so it goes in a folder of its own that is removed afterwards
+    pathlib.Path(f"{temp_folder}/cores").mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=f"{temp_folder}/cores") as output_folder:
+        with shape_builders.builder() as builder:
+            step_path, stl_path = builder.get_core(project_name=project_name,
+                                                   geometrical_description=geometrical_description,
+                                                   output_path=output_folder)
+        path = stl_path if stl_or_not_step else step_path
+
+        print(path)
+        if path is None:
             return None
 
-    timeout = 0
-    while os.stat(f"{temp_folder}/{hash_value}.svg").st_size == 0 or current_size != os.stat(f"{temp_folder}/{hash_value}.svg").st_size:
-        current_size = os.stat(f"{temp_folder}/{hash_value}.svg").st_size
-        time.sleep(0.01)
-        timeout += 1
-        if timeout == 1000:
+        with open(path, "rb") as model:
+            return model.read()
+
+
+# Pieces are cached in their own place and moved into the position of each assembly, so changing
+# the gap or the number of stacks only builds the pieces that are really new. Piece coordinates are
+# in meters and FreeCAD meshes in millimeters; whether the meshes line up is checked against a full
+# build, once per shape family, and pieces of a family are not used if they do not. The result is
+# kept in the plot cache, so restarted workers do not check again.
+assemble_pieces = ast.literal_eval(os.getenv('OM_ASSEMBLE_PIECES', "True"))
+piece_translation_scale = float(os.getenv('OM_PIECE_TRANSLATION_SCALE', 1000))
+# Shape families whose assemblies matched a full build (True) or did not (False), as read from the plot cache
+pieces_verified = {}
+
+
+def build_piece_mesh(cache, piece, temp_folder):
+    """Triangles of a piece built at the origin, from the cache when any assembly used it before"""
+    piece = dict(piece, coordinates=[0, 0, 0])
+    piece_hash = hash_request({"piece": piece}, "core_piece_stl")
+    artifact = cache.read_artifact(piece_hash)
+    # Not under single_flight, the assembly already holds a lock that may share its stripe
+    if artifact is None or artifact.content_type != "model/stl":
+        data = build_core_model([piece], temp_folder, piece_hash)
+        if data is None:
             return None
+        artifact = cache.insert_artifact(piece_hash, meshes.to_binary_stl(data), "model/stl")
+    return meshes.read_stl(artifact.decode())
 
-    with open(f"{temp_folder}/{hash_value}.svg", "rb") as svg:
-        cache.insert_plot(hash_value, svg.read().decode("utf-8"))
 
-    return f"{temp_folder}/{hash_value}.svg"
+def assemble_core_mesh(cache, geometrical_description, temp_folder):
+    triangles = []
+    for piece in geometrical_description:
+        piece_triangles = build_piece_mesh(cache, piece, temp_folder)
+        if piece_triangles is None:
+            return None
+        offset = numpy.array(piece['coordinates'], dtype=numpy.float32) * piece_translation_scale
+        triangles.append(piece_triangles + offset)
+    return meshes.write_binary_stl(numpy.concatenate(triangles))
 
 
-@app.task
-def task_plot_wire(data, temp_folder):
-    aux = {
-        "wire": data["wire"]
-    }
+def assembly_family(geometrical_description):
+    return ",".join(sorted({str(piece['shape'].get('family')) for piece in geometrical_description if isinstance(piece.get('shape'), dict)}))
 
-    hash_value = hashlib.sha256(str(aux).encode()).hexdigest()
-    cache = PlotCacheTable()
 
-    cached_datum = cache.read_plot(hash_value)
-    if cached_datum is not None:
-        print("Hit in cache!")
-        return cached_datum
+def exercises_assembly(geometrical_description):
+    """Whether assembling the core moves pieces at all: with fewer than two distinct non zero coordinates
+    the scale and placement of the translations would match a full build whatever they were"""
+    coordinates = {tuple(piece.get('coordinates') or [0, 0, 0]) for piece in geometrical_description}
+    return len([position for position in coordinates if any(value != 0 for value in position)]) >= 2
 
-    settings = PyMKF.get_settings()
-    settings["painterSimpleLitz"] = False
-    settings["painterAdvancedLitz"] = False
-    settings["painterColorBobbin"] = "0x539796"
-    settings["painterColorMargin"] = "0xfff05b"
-    settings["painterCciCoordinatesPath"] = "/opt/openmagnetics/cci_coords/coordinates/"
-    PyMKF.set_settings(settings)
 
-    # print(data["wire"])
-    PyMKF.plot_wire(data["wire"], f"{temp_folder}/{hash_value}.svg", "/opt/openmagnetics/cci_coords/coordinates/")
-    timeout = 0
-    current_size = 0
-    while not os.path.exists(f"{temp_folder}/{hash_value}.svg"):
-        time.sleep(0.01)
-        timeout += 1
-        if timeout == 200:
-            return None
+def same_vertices(triangles, other_triangles):
+    """Whether two meshes have the same vertices, up to a thousandth of their size"""
+    tolerance = 1e-3 * float(numpy.ptp(other_triangles.reshape(-1, 3), axis=0).max())
+    if tolerance <= 0:
+        return False
+    vertices = numpy.unique(numpy.round(triangles.reshape(-1, 3) / tolerance).astype(numpy.int64), axis=0)
+    other_vertices = numpy.unique(numpy.round(other_triangles.reshape(-1, 3) / tolerance).astype(numpy.int64), axis=0)
+    return vertices.shape == other_vertices.shape and int(numpy.abs(vertices - other_vertices).max(initial=0)) <= 1
 
-    timeout = 0
-    while os.stat(f"{temp_folder}/{hash_value}.svg").st_size == 0 or current_size != os.stat(f"{temp_folder}/{hash_value}.svg").st_size:
-        current_size = os.stat(f"{temp_folder}/{hash_value}.svg").st_size
-        time.sleep(0.01)
-        timeout += 1
-        if timeout == 1000:
-            return None
 
-    with open(f"{temp_folder}/{hash_value}.svg", "rb") as svg:
-        cache.insert_plot(hash_value, svg.read().decode("utf-8"))
+def assembly_verification_hash(family):
+    # The check is only valid for the scale it was made with
+    return hash_request({"family": family, "scale": piece_translation_scale}, "assembly_verified")
 
-    return f"{temp_folder}/{hash_value}.svg"
 
+def read_pieces_verified(cache, family):
+    if family not in pieces_verified:
+        verified = read_cached(cache, assembly_verification_hash(family))
+        if verified is not None:
+            pieces_verified[family] = verified
+    return pieces_verified.get(family)
 
-@app.task
-def task_plot_wire_and_current_density(data, temp_folder):
-    aux = {
-        "wire": data["wire"],
-        "operatingPoint": data["operatingPoint"],
-    }
 
-    hash_value = hashlib.sha256(str(aux).encode()).hexdigest()
-    cache = PlotCacheTable()
+def mark_pieces_verified(cache, family, verified):
+    pieces_verified[family] = verified
+    cache.insert_artifact(assembly_verification_hash(family), json.dumps(verified).encode("utf-8"), "application/json")
+    print(f"Assembling {family} cores from cached pieces {'matches' if verified else 'does not match'} building them whole")
 
-    cached_datum = cache.read_plot(hash_value)
-    if cached_datum is not None:
-        print("Hit in cache!")
-        return cached_datum
 
-    settings = PyMKF.get_settings()
-    settings["painterSimpleLitz"] = False
-    settings["painterAdvancedLitz"] = False
-    settings["painterCciCoordinatesPath"] = "/opt/openmagnetics/cci_coords/coordinates/"
-    PyMKF.set_settings(settings)
+def build_core_mesh(cache, geometrical_description, temp_folder, project_name):
+    """STL of the whole core, assembled from cached pieces when possible"""
+    if not assemble_pieces:
+        return build_core_model(geometrical_description, temp_folder, project_name)
+    family = assembly_family(geometrical_description)
+    verified = read_pieces_verified(cache, family)
+    if verified is False:
+        return build_core_model(geometrical_description, temp_folder, project_name)
 
-    PyMKF.plot_current_density(data["wire"], data["operatingPoint"], f"{temp_folder}/{hash_value}.svg")
-    timeout = 0
-    current_size = 0
-    while not os.path.exists(f"{temp_folder}/{hash_value}.svg"):
-        time.sleep(0.01)
-        timeout += 1
-        if timeout == 200:
-            return None
+    if verified:
+        assembled = assemble_core_mesh(cache, geometrical_description, temp_folder)
+        if assembled is not None:
+            return assembled
+        # A piece failed to build on its own, the whole core may still build
+        return build_core_model(geometrical_description, temp_folder, project_name)
 
-    timeout = 0
-    while os.stat(f"{temp_folder}/{hash_value}.svg").st_size == 0 or current_size != os.stat(f"{temp_folder}/{hash_value}.svg").st_size:
-        current_size = os.stat(f"{temp_folder}/{hash_value}.svg").st_size
-        time.sleep(0.01)
-        timeout += 1
-        if timeout == 1000:
-            return None
+    built = build_core_model(geometrical_description, temp_folder, project_name)
+    if built is not None and exercises_assembly(geometrical_description):
+        assembled = assemble_core_mesh(cache, geometrical_description, temp_folder)
+        if assembled is not None:
+            mark_pieces_verified(cache, family, same_vertices(meshes.read_stl(assembled), meshes.read_stl(built)))
+    return built
 
-    with open(f"{temp_folder}/{hash_value}.svg", "rb") as svg:
-        cache.insert_plot(hash_value, svg.read().decode("utf-8"))
 
-    return f"{temp_folder}/{hash_value}.svg"
+def encode_core_3d_model(data, model_format, lod):
+    """Bytes to store of the file FreeCAD wrote, in the given format and level of detail"""
+    if lod == 0 and model_format in ("json", "step"):
+        return data
+    triangles = meshes.read_stl(data)
+    if lod != 0:
+        triangles = meshes.decimate(triangles, core_3d_model_lods[lod])
+    if model_format == "glb":
+        return meshes.write_glb(triangles)
+    if lod == 0:
+        return meshes.to_binary_stl(data)
+    return meshes.write_binary_stl(triangles)
+
+
+def store_core_3d_model(cache, hash_value, data, model_format, content_type):
+    """Caches a model, returning it as base64 text, whatever its format, so it travels through the result backend"""
+    if model_format == "json":
+        data = base64.b64encode(data).decode('utf-8')
+        # Stored as the JSON body the endpoint answers with, so hits are sent without touching it
+        cache.insert_artifact(hash_value, json.dumps(data).encode("utf-8"), content_type)
+        return data
+    cache.insert_artifact(hash_value, data, content_type)
+    return base64.b64encode(data).decode('utf-8')
+
+
+@app.task(**task_options("heavy"))
+def task_generate_core_3d_model(core, temp_folder, stl_or_not_step=True, model_format="json", lod=0):
+    """Returns the model as base64 text, whatever its format, so it travels through the result backend.
+
+    Building the mesh is what takes time, so every level of detail of an STL mesh is cached when any
+    of them is requested, and the client can ask for the coarse one first and then the full one.
+    """
+    content_type = core_3d_model_formats[stl_or_not_step][model_format]
+    hash_value, core = prepare_core_3d_model(core, stl_or_not_step, model_format, lod)
+
+    def render(cache):
+        if stl_or_not_step:
+            data = build_core_mesh(cache, core['geometricalDescription'], temp_folder, hash_value)
+        else:
+            data = build_core_model(core['geometricalDescription'], temp_folder, hash_value, False)
+        if data is None:
+            return None
 
+        if stl_or_not_step:
+            for other_lod in core_3d_model_lods:
+                if other_lod != lod:
+                    store_core_3d_model(cache, core_3d_model_hash(core, stl_or_not_step, model_format, other_lod),
+                                        encode_core_3d_model(data, model_format, other_lod), model_format, content_type)
+        return store_core_3d_model(cache, hash_value, encode_core_3d_model(data, model_format, lod), model_format, content_type)
 
-@app.task
-def task_generate_core_technical_drawing(data, temp_folder):
-    if 'familySubtype' in data:
-        data['familySubtype'] = str(data['familySubtype'])
+    return cached_render(hash_value, lambda cache: read_cached_model(cache, hash_value, content_type), render, "Wrong dimensions")
 
-    coreShape = CoreShape(**data)
-    coreShape = coreShape.dict()
-    aux = {
-        "coreShape": coreShape,
-    }
-    hash_value = hashlib.sha256(str(aux).encode()).hexdigest()
-    cache = PlotCacheTable()
 
-    cached_datum = cache.read_plot(hash_value)
-    if cached_datum is not None:
-        print("Hit in cache!")
-        return ast.literal_eval(cached_datum)
+core_shape_content_types = {
+    True: "model/stl",
+    False: "model/step",
+}
 
-    core_builder = ShapeBuilder("FreeCAD").factory(coreShape)
-    core_builder.set_output_path(f"{temp_folder}/")
-    colors = {
-        "projection_color": "#d4d4d4",
-        "dimension_color": "#d4d4d4"
-    }
-    views = core_builder.get_piece_technical_drawing(coreShape, colors)
 
-    if views['top_view'] is None or views['front_view'] is None:
+def compute_core_shape(coreShape, temp_folder, stl_or_not_step=True):
+    """Builds a single piece of a shape, returning it as a cached artifact, or None if FreeCAD could not build it"""
+    hash_value, coreShape = prepare_core_shape(coreShape, stl_or_not_step)
+    content_type = core_shape_content_types[stl_or_not_step]
+
+    def read(cache):
+        artifact = cache.read_artifact(hash_value)
+        if artifact is not None and artifact.content_type == content_type:
+            return artifact
         return None
-    else:
-        cache.insert_plot(hash_value, str(views))
-        return views
 
+    def render(cache):
+        pathlib.Path(temp_folder).mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=temp_folder) as output_folder:
+            with shape_builders.builder() as builder:
+                core_builder = builder.factory(coreShape)
+                core_builder.set_output_path(output_folder)
+                step_path, stl_path = core_builder.get_piece(coreShape)
+            if step_path is None:
+                return None
 
-@app.task
-def task_generate_gapping_technical_drawing(data, temp_folder):
-    if 'familySubtype' in data['functionalDescription']['shape']:
-        data['functionalDescription']['shape']['familySubtype'] = str(data['functionalDescription']['shape']['familySubtype'])
+            with open(stl_path if stl_or_not_step else step_path, "rb") as piece:
+                data = piece.read()
+        return cache.insert_artifact(hash_value, data, content_type)
 
-    core = MagneticCore(**data)
-    core = core.dict()
-    aux = {
-        "core": core,
-    }
-    hash_value = hashlib.sha256(str(aux).encode()).hexdigest()
-    cache = PlotCacheTable()
+    return cached_render(hash_value, read, render, "Wrong dimensions")
 
-    cached_datum = cache.read_plot(hash_value)
-    if cached_datum is not None:
-        print("Hit in cache!")
-        return ast.literal_eval(cached_datum)
 
-    colors = {
-        "projection_color": "#d4d4d4",
-        "dimension_color": "#d4d4d4"
-    }
+@app.task(**task_options("interactive"))
+def task_plot_core_and_fields(data, temp_folder):
+    hash_value, data = prepare_plot_core_and_fields(data)
 
-    views = ShapeBuilder("FreeCAD").get_core_gapping_technical_drawing(project_name=core['functionalDescription']['shape']['name'],
-                                                                       core_data=core,
-                                                                       colors=colors,
-                                                                       save_files=False)
+    def render(cache):
+        with render_settings.apply(render_profile("core_fields_dark", painterIncludeFringing=data["includeFringing"])):
+            svg = render_svg(temp_folder,
+                             lambda path: PyMKF.plot_field(data["magnetic"], data["operatingPoint"], path),
+                             lambda: PyOpenMagnetics.plot_magnetic_field(data["magnetic"], data["operatingPoint"]))
+        return store_svg(cache, hash_value, svg)
 
-    if views['top_view'] is None or views['front_view'] is None:
-        return None
-    else:
-        cache.insert_plot(hash_value, str(views))
-        return views
+    return cached_render(hash_value, lambda cache: read_cached(cache, hash_value), render, "Plotting failed")
+
+
+@app.task(**task_options("interactive"))
+def task_plot_core(data, temp_folder):
+    hash_value, data = prepare_plot_core(data)
+
+    def render(cache):
+        with render_settings.apply(render_profile("core_turns")):
+            svg = render_svg(temp_folder,
+                             lambda path: PyMKF.plot_turns(data["magnetic"], path),
+                             lambda: PyOpenMagnetics.plot_magnetic(data["magnetic"]))
+        return store_svg(cache, hash_value, svg)
+
+    return cached_render(hash_value, lambda cache: read_cached(cache, hash_value), render, "Plotting failed")
+
+
+@app.task(**task_options("interactive"))
+def task_plot_wire(data, temp_folder):
+    hash_value, data = prepare_plot_wire(data)
+
+    def render(cache):
+        with render_settings.apply(render_profile("wire_light")):
+            svg = render_svg(temp_folder,
+                             lambda path: PyMKF.plot_wire(data["wire"], path, cci_coordinates_path),
+                             lambda: PyOpenMagnetics.plot_wire(data["wire"]))
+        return store_svg(cache, hash_value, svg)
+
+    return cached_render(hash_value, lambda cache: read_cached(cache, hash_value), render, "Plotting failed")
+
+
+@app.task(**task_options("interactive"))
+def task_plot_wire_and_current_density(data, temp_folder):
+    hash_value, data = prepare_plot_wire_and_current_density(data)
+
+    def render(cache):
+        with render_settings.apply(render_profile("wire_current_density")):
+            svg = render_svg(temp_folder,
+                             lambda path: PyMKF.plot_current_density(data["wire"], data["operatingPoint"], path),
+                             lambda: PyOpenMagnetics.plot_wire_current_density(data["wire"], data["operatingPoint"]))
+        return store_svg(cache, hash_value, svg)
+
+    return cached_render(hash_value, lambda cache: read_cached(cache, hash_value), render, "Plotting failed")
+
+
+technical_drawing_colors = {
+    "projection_color": "#d4d4d4",
+    "dimension_color": "#d4d4d4"
+}
+
+
+@app.task(**task_options("heavy"))
+def task_generate_core_technical_drawing(data, temp_folder):
+    hash_value, coreShape = prepare_core_technical_drawing(data)
+
+    def render(cache):
+        with shape_builders.builder() as builder:
+            core_builder = builder.factory(coreShape)
+            core_builder.set_output_path(f"{temp_folder}/")
+            views = core_builder.get_piece_technical_drawing(coreShape, technical_drawing_colors)
+        return store_views(cache, hash_value, views)
+
+    return cached_render(hash_value, lambda cache: read_cached(cache, hash_value, ast.literal_eval), render, "Wrong dimensions")
+
+
+@app.task(**task_options("heavy"))
+def task_generate_gapping_technical_drawing(data, temp_folder):
+    hash_value, core = prepare_gapping_technical_drawing(data)
+
+    def render(cache):
+        with shape_builders.builder() as builder:
+            views = builder.get_core_gapping_technical_drawing(project_name=core['functionalDescription']['shape']['name'],
+                                                               core_data=core,
+                                                               colors=technical_drawing_colors,
+                                                               save_files=False)
+        return store_views(cache, hash_value, views)
+
+    return cached_render(hash_value, lambda cache: read_cached(cache, hash_value, ast.literal_eval), render, "Wrong dimensions")
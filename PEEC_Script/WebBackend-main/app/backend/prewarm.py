@@ -0,0 +1,228 @@
+"""Renders the 3D models (STL, STEP and GLB) and technical drawings of every catalog core shape into the plot cache,
+so the first visit to a catalog part is served from the cache.
+
+Usage:
+    python prewarm.py              # Enqueue the prewarm on the batch queue of the Celery workers
+    python prewarm.py --local      # Render in this process instead
+    python prewarm.py --force      # Render every shape again, not only the new or changed ones
+    python prewarm.py --material 3C97
+    python prewarm.py --check core.json    # Whether a core posted by the frontend gets the key a prewarm stores
+    python prewarm.py --check-catalog 20   # The same for that many catalog shapes, posted as the frontend would
+
+A shape is recorded once its artifacts are cached, so an interrupted run resumes where it stopped
+and the next run only renders the shapes whose data changed. The 3D models are keyed on the geometry
+alone, so the material is only used to calculate the core data and the models of one serve every material.
+plot_core needs a whole magnetic, coil included, so catalog shapes alone do not determine it and it is not prewarmed.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+from plotter import app, task_options, PyOpenMagnetics
+from plotter import task_generate_core_3d_model, task_generate_core_technical_drawing, prepare_core_3d_model
+from models import PrewarmedShapesTable
+from mas_fingerprint import fingerprint
+
+
+default_material = os.getenv('OM_PREWARM_MATERIAL', "3C95")
+temp_folder = "/opt/openmagnetics/temp"
+# Bump when the artifacts rendered for a shape change, so every shape is rendered again
+prewarm_version = 4
+
+
+def catalog_shape_names():
+    if PyOpenMagnetics is None:
+        raise RuntimeError("Enumerating the catalog needs PyOpenMagnetics")
+    return PyOpenMagnetics.get_core_shape_names(include_toroidal=True)
+
+
+def catalog_core(shape, material):
+    """Ungapped single stack core of a catalog shape, before its data is calculated"""
+    family = shape.get('family', '').lower()
+    if family == 't':
+        core_type = 'toroidal'
+    elif family in ('u', 'ui', 'ur', 'ut'):
+        core_type = 'closed shape'
+    else:
+        core_type = 'two-piece set'
+    return {
+        'functionalDescription': {
+            'name': shape['name'],
+            'type': core_type,
+            'shape': shape,
+            'material': material,
+            'gapping': [],
+            'numberStacks': 1
+        }
+    }
+
+
+def calculate_core_data(core, include_material_data=True):
+    """Adds the processed and geometrical descriptions, as the frontend does before posting a core;
+    the 3D models are built and keyed on the geometrical one"""
+    result = PyOpenMagnetics.calculate_core_data(core, include_material_data)
+    if isinstance(result, str):
+        if result.startswith("Exception"):
+            raise RuntimeError(f"Could not calculate the data of {core['functionalDescription']['name']}: {result}")
+        result = json.loads(result)
+    if isinstance(result, dict) and result.get('geometricalDescription') is None:
+        raise RuntimeError(f"Could not calculate the data of {core['functionalDescription']['name']}: {result}")
+    return result
+
+
+def shape_fingerprint(shape):
+    return fingerprint({"shape": shape, "version": prewarm_version}, "prewarm", ignored=frozenset())
+
+
+def render_shape(shape, material):
+    """Renders every artifact of a shape, returning how many were rendered and how many failed"""
+    core = calculate_core_data(catalog_core(shape, material))
+    results = [
+        task_generate_core_3d_model(core, temp_folder, True),
+        task_generate_core_3d_model(core, temp_folder, False),
+        task_generate_core_3d_model(core, temp_folder, True, "glb"),
+        task_generate_core_technical_drawing(shape, temp_folder),
+    ]
+    failed = sum(1 for result in results if result is None)
+    return len(results) - failed, failed
+
+
+def shapes_to_prewarm():
+    prewarmed = PrewarmedShapesTable().read_fingerprints()
+    for name in catalog_shape_names():
+        try:
+            shape = PyOpenMagnetics.find_core_shape_by_name(name)
+        except Exception as e:
+            print(f"Could not read shape {name}: {e}")
+            continue
+        shape_hash = shape_fingerprint(shape)
+        if prewarmed.get(name) != shape_hash:
+            yield name, shape_hash
+
+
+def check_payload(path):
+    """Compares the key of the STL model of a core posted by the frontend, or of the core of a posted
+    magnetic or MAS, with the key the prewarm stores for its shape"""
+    with open(path) as payload_file:
+        core = json.load(payload_file)
+    core = core.get('magnetic', core)
+    core = core.get('core', core)
+    functional_description = core['functionalDescription']
+    shape = functional_description['shape']
+    shape_name = shape if isinstance(shape, str) else shape['name']
+    if len(functional_description.get('gapping') or []) > 0 or functional_description.get('numberStacks', 1) != 1:
+        print("Only ungapped single stack cores are prewarmed, this one never matches")
+
+    posted_hash, prewarmed_hash = posted_and_prewarmed_hashes(core, PyOpenMagnetics.find_core_shape_by_name(shape_name))
+    print(f"Posted core:    {posted_hash}")
+    print(f"Prewarmed core: {prewarmed_hash}")
+    return posted_hash == prewarmed_hash
+
+
+def posted_and_prewarmed_hashes(core, shape):
+    prewarmed = calculate_core_data(catalog_core(shape, default_material))
+    posted_hash, _ = prepare_core_3d_model(core, True)
+    prewarmed_hash, _ = prepare_core_3d_model(prewarmed, True)
+    return posted_hash, prewarmed_hash
+
+
+def as_posted(value):
+    """A core as the browser serializes it, which writes whole numbers without decimals and -0.0 as 0"""
+    if isinstance(value, dict):
+        return {key: as_posted(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [as_posted(item) for item in value]
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def check_catalog(count, material):
+    """Posts every nth catalog shape as the frontend would, with another material than the prewarm,
+    returning how many were checked and how many got another key than the prewarmed one"""
+    names = catalog_shape_names()
+    step = max(1, len(names) // count)
+    checked = 0
+    mismatches = 0
+    for name in names[::step][:count]:
+        shape = PyOpenMagnetics.find_core_shape_by_name(name)
+        try:
+            posted = as_posted(calculate_core_data(catalog_core(shape, material), False))
+            posted_hash, prewarmed_hash = posted_and_prewarmed_hashes(posted, shape)
+        except Exception as e:
+            print(f"Could not check {name}: {e}")
+            continue
+        checked += 1
+        if posted_hash != prewarmed_hash:
+            mismatches += 1
+            print(f"Different keys for {name}: {posted_hash} != {prewarmed_hash}")
+    return checked, mismatches
+
+
+# Named explicitly, the command runs this file as __main__
+@app.task(name="prewarm.task_prewarm_shape", **task_options("batch"))
+def task_prewarm_shape(name, material=default_material, shape_hash=None):
+    shape = PyOpenMagnetics.find_core_shape_by_name(name)
+    if shape_hash is None:
+        shape_hash = shape_fingerprint(shape)
+    rendered, failed = render_shape(shape, material)
+    # Failed renders are recorded too, they fail the same way every time
+    PrewarmedShapesTable().mark_prewarmed(name, shape_hash, rendered, failed)
+    return {"name": name, "rendered": rendered, "failed": failed}
+
+
+@app.task(name="prewarm.task_prewarm_catalog", **task_options("batch"))
+def task_prewarm_catalog(material=default_material, force=False):
+    """Enqueues one prewarm task per new or changed shape, so the batch workers render them in parallel"""
+    if force:
+        PrewarmedShapesTable().forget_all()
+    enqueued = 0
+    for name, shape_hash in shapes_to_prewarm():
+        task_prewarm_shape.apply_async(args=[name, material, shape_hash])
+        enqueued += 1
+    print(f"Enqueued {enqueued} shapes to prewarm")
+    return enqueued
+
+
+def prewarm_locally(material, force=False):
+    if force:
+        PrewarmedShapesTable().forget_all()
+    pending = list(shapes_to_prewarm())
+    print(f"Shapes to prewarm: {len(pending)}")
+    t_start = time.time()
+    for i, (name, shape_hash) in enumerate(pending):
+        try:
+            task_prewarm_shape(name, material, shape_hash)
+        except Exception as e:
+            # Left unrecorded, so the next run tries it again
+            print(f"Could not prewarm {name}: {e}")
+        if (i + 1) % 50 == 0:
+            elapsed = time.time() - t_start
+            remaining = (len(pending) - i - 1) * elapsed / (i + 1)
+            print(f"  Prewarmed {i+1}/{len(pending)} ({elapsed:.0f}s elapsed, ~{remaining:.0f}s remaining)...")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Render the catalog core shapes into the plot cache")
+    parser.add_argument('--local', action='store_true', help="render in this process instead of on the Celery workers")
+    parser.add_argument('--force', action='store_true', help="render every shape again")
+    parser.add_argument('--material', default=default_material)
+    parser.add_argument('--check', metavar='PAYLOAD', help="compare the key of a core posted by the frontend with the prewarmed one")
+    parser.add_argument('--check-catalog', metavar='SHAPES', type=int, help="compare the keys of that many catalog shapes posted with --material")
+    args = parser.parse_args()
+
+    if args.check:
+        matches = check_payload(args.check)
+        print("Same key, served from the prewarm" if matches else "Different keys, not served from the prewarm")
+        sys.exit(0 if matches else 1)
+    elif args.check_catalog:
+        checked, mismatches = check_catalog(args.check_catalog, args.material)
+        print(f"{mismatches} of {checked} checked shapes with different keys")
+        sys.exit(0 if checked > 0 and mismatches == 0 else 1)
+    elif args.local:
+        prewarm_locally(args.material, args.force)
+    else:
+        task_prewarm_catalog.delay(args.material, args.force)
+        print("Prewarm enqueued on the batch queue")
@@ -0,0 +1,128 @@
+import queue
+import threading
+import time
+import sqlalchemy.exc
+
+
+class WriterBusy(Exception):
+    pass
+
+
+class BatchWriter:
+    """Buffers rows in memory and writes them in batches from a background thread.
+
+    A batch is written once it has max_batch rows or its oldest row has waited max_delay seconds.
+    When the database cannot be reached (retry_on), the failed batch is retried with backoff while new
+    rows fill the buffer, and once max_pending are waiting submit raises WriterBusy instead of growing
+    it further. Any other error is blamed on the rows: the batch is split in halves until the rows the
+    database rejects are found, and those are dropped.
+    """
+
+    def __init__(self, name, write_batch, max_batch=200, max_delay=1.0, max_pending=5000,
+                 retry_on=(sqlalchemy.exc.OperationalError, sqlalchemy.exc.InterfaceError)):
+        self.name = name
+        self.write_batch = write_batch
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.retry_on = retry_on
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.thread = None
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.written = 0
+        self.batches = 0
+        self.failures = 0
+        self.rejected = 0
+        self.dropped = 0
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.stopping.clear()
+                self.thread = threading.Thread(target=self.run, name=f"{self.name}-writer", daemon=True)
+                self.thread.start()
+
+    def submit(self, row):
+        self.start()
+        try:
+            self.pending.put_nowait(row)
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            raise WriterBusy(self.name)
+        with self.lock:
+            self.submitted += 1
+
+    def next_batch(self):
+        try:
+            batch = [self.pending.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 and not self.stopping.is_set():
+                break
+            try:
+                # Once stopping, whatever is already buffered goes in this batch
+                batch.append(self.pending.get(timeout=remaining) if remaining > 0 else self.pending.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def write(self, batch):
+        delay = 0.5
+        while True:
+            try:
+                self.write_batch(batch)
+                with self.lock:
+                    self.written += len(batch)
+                    self.batches += 1
+                return True
+            except self.retry_on as e:
+                with self.lock:
+                    self.failures += 1
+                print(f"Could not write {len(batch)} rows of {self.name}: {e}")
+                if self.stopping.is_set():
+                    return False
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+            except Exception as e:
+                with self.lock:
+                    self.failures += 1
+                if len(batch) == 1:
+                    with self.lock:
+                        self.dropped += 1
+                    print(f"Dropped a row of {self.name} the database rejects: {e}")
+                    return True
+                middle = len(batch) // 2
+                return self.write(batch[:middle]) and self.write(batch[middle:])
+
+    def run(self):
+        while not (self.stopping.is_set() and self.pending.empty()):
+            batch = self.next_batch()
+            if len(batch) > 0 and not self.write(batch):
+                print(f"Dropped {len(batch)} rows of {self.name} while stopping")
+
+    def stop(self, timeout=10):
+        """Writes what is buffered before returning, or gives up after timeout seconds"""
+        with self.lock:
+            thread = self.thread
+            self.thread = None
+        if thread is None:
+            return
+        self.stopping.set()
+        thread.join(timeout)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "pending": self.pending.qsize(),
+                "submitted": self.submitted,
+                "written": self.written,
+                "batches": self.batches,
+                "failures": self.failures,
+                "rejected": self.rejected,
+                "dropped": self.dropped,
+            }
@@ -0,0 +1,63 @@
+"""Checks that /create_simulation_from_mas streams the archive of the high performance backend through,
+against a mock backend that compresses it when asked to, or always.
+
+Usage:
+    python check_proxy.py
+"""
+import asyncio
+import gzip
+import os
+import httpx
+import api
+
+mas = b'{"magnetic": {}}' * 1000
+# Half random so it compresses, but not to nothing
+archive = b"".join(os.urandom(512) + b"\0" * 512 for _ in range(3 * api.proxy_chunk_size // 1024))
+
+
+async def chunks(body):
+    # Streamed like a real response, httpx reads whole byte bodies up front
+    for start in range(0, len(body), 65536):
+        yield body[start:start + 65536]
+
+
+def mock_backend(always_compress):
+    def handle(request):
+        if request.content != mas:
+            return httpx.Response(400)
+        body, headers = archive, {}
+        if always_compress or "gzip" in request.headers.get("accept-encoding", ""):
+            body, headers = gzip.compress(archive), {"content-encoding": "gzip"}
+        headers["content-length"] = str(len(body))
+        return httpx.Response(200, content=chunks(body), headers=headers)
+    return handle
+
+
+async def post(accept_encoding, always_compress=False):
+    api.http_client = httpx.AsyncClient(transport=httpx.MockTransport(mock_backend(always_compress)))
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=api.app), base_url="http://api") as client:
+        async with client.stream("POST", "/create_simulation_from_mas", content=mas,
+                                 headers={"content-type": "application/json", "accept-encoding": accept_encoding}) as response:
+            raw = b"".join([chunk async for chunk in response.aiter_raw()])
+    await api.http_client.aclose()
+
+    encoding = response.headers.get("content-encoding")
+    body = gzip.decompress(raw) if encoding == "gzip" else raw
+    if response.status_code != 200 or body != archive:
+        raise AssertionError(f"Accept-Encoding {accept_encoding!r}: status {response.status_code}, {len(body)} bytes instead of {len(archive)}")
+    length = response.headers.get("content-length")
+    if length is not None and int(length) != len(raw):
+        raise AssertionError(f"Accept-Encoding {accept_encoding!r}: content-length {length} for {len(raw)} bytes sent")
+    print(f"{accept_encoding!r:<12}{'always' if always_compress else 'asked':<8}{str(encoding):<10}{str(length):>10}{len(raw):>10}")
+
+
+async def main():
+    print(f"{'accepts':<12}{'gzips':<8}{'encoding':<10}{'length':>10}{'sent':>10}")
+    await post("gzip, br")
+    await post("identity")
+    await post("gzip;q=0")
+    await post("identity", always_compress=True)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -11,12 +11,15 @@ Usage:
 """
 
 import cmath
-import hashlib
 import json
 import math
 import os
 import sys
 
+# Same fingerprint as the web backend caches
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "WebBackend-main", "app", "backend"))
+from mas_fingerprint import fingerprint
+
 try:
     import PyOpenMagnetics as pm
 except Exception as exc:
@@ -446,12 +449,9 @@ def build_excitation(cfg):
 
 
 def compute_hash(cfg):
-    filtered = dict(cfg)
-    for k in ["output_file", "cache_file", "use_cache", "use_import", "import_file"]:
-        if k in filtered:
-            del filtered[k]
-    payload = json.dumps(filtered, sort_keys=True, separators=(",", ":"))
-    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+    # Only the file handling options are ignored; names in the config may change the excitation
+    return fingerprint(cfg, "om_excitation",
+                       ignored={"output_file", "cache_file", "use_cache", "use_import", "import_file"})
 
 
 def try_load_json(path):